@@ -1,21 +1,21 @@
 import os
 import streamlit as st
-import google.generativeai as genai
 from dotenv import load_dotenv
-import notion_client
 import streamlit_authenticator as stauth
-from cryptography.fernet import Fernet
 import logging
 import traceback
-# ★★★ Firebase Admin SDKの公式なインポート ★★★
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
 import hashlib
 import base64
+from types import SimpleNamespace
 
 from notion_utils import get_all_databases, get_pages_in_database
-from core_logic import run_new_page_process, run_edit_page_process
+from cache_backend import cached, get_cache
+from core_logic import run_new_page_process, run_edit_page_process, run_patch_page_process, run_bulk_edit_process
+import job_queue
+import notion_index
+from gemini_governor import create_model
+import usage_meter
+import run_profiler
 
 # .envファイルから環境変数を読み込む (ローカル開発用)
 load_dotenv()
@@ -31,6 +31,11 @@ st.set_page_config(page_title="Notion記事自動生成AI", layout="wide")
 def initialize_firestore():
     """Firebase Admin SDKを初期化し、Firestoreクライアントを返す"""
     try:
+        # ★★★ Firebase Admin SDKの公式なインポート（起動を速くするため、初めて必要になった時に読み込む） ★★★
+        import firebase_admin
+        from firebase_admin import credentials
+        from firebase_admin import firestore
+
         # Streamlit Secretsから認証情報を辞書として取得
         secrets_dict = st.secrets["FIREBASE_SERVICE_ACCOUNT"]
         
@@ -59,7 +64,9 @@ def initialize_firestore():
         st.exception(e) # 詳細なエラー情報を画面に表示
         st.stop()
 
-db = initialize_firestore()
+def get_db():
+    """Firestoreクライアントを返す。共有キャッシュにヒットする間はFirebase Admin SDKの読み込み自体を省略できる"""
+    return initialize_firestore()
 
 # --- 認証情報とAPIキーの管理 ---
 def generate_fernet_key(secret_string: str) -> bytes:
@@ -68,45 +75,67 @@ def generate_fernet_key(secret_string: str) -> bytes:
     hasher.update(secret_string.encode('utf-8'))
     return base64.urlsafe_b64encode(hasher.digest())
 
-try:
-    # SecretsからENCRYPTION_SECRETを取得し、それを元にFernetキーを生成
-    fernet_key = generate_fernet_key(st.secrets["ENCRYPTION_SECRET"])
-    fernet = Fernet(fernet_key)
-except KeyError:
+if "ENCRYPTION_SECRET" not in st.secrets:
     st.error("ENCRYPTION_SECRETが設定されていません。StreamlitのSecretsを確認してください。")
     st.stop()
 
+@st.cache_resource
+def get_fernet():
+    """SecretsのENCRYPTION_SECRETを元に、APIキー暗号化用のFernetを返す（cryptographyは初回利用時に読み込む）"""
+    from cryptography.fernet import Fernet
+    return Fernet(generate_fernet_key(st.secrets["ENCRYPTION_SECRET"]))
+
 
 
 
 # app.py の fetch_config_from_firestore 関数を以下に置き換えてください
 
-@st.cache_data(ttl=600)
+# ユーザー一覧はレプリカ間で共有キャッシュする（秘密情報を含む cookie 設定とパスワードハッシュは共有層に入れない）
+@cached("user_config", ttl=600)
+def fetch_users_from_firestore():
+    """Firestoreからユーザー一覧を読み込み、authenticatorが要求する usernames 形式の辞書を返す（passwordは含まない）"""
+    users_ref = get_db().collection('users')
+    users_docs = users_ref.stream()
+
+    usernames_dict = {}
+    for doc in users_docs:
+        user_data = doc.to_dict()
+        username = doc.id
+
+        # 基本的なユーザー情報を作成
+        user_entry = {
+            'email': user_data.get('email'),
+            'name': user_data.get('name'),
+            # これらはライブラリが実行時に管理
+            'logged_in': False,
+            'failed_login_attempts': 0
+        }
+
+        usernames_dict[username] = user_entry
+    return usernames_dict
+
+# パスワードハッシュは共有層（cache.sqlite3 / Redis）に書き込まず、各プロセスのメモリにだけ保持する。
+# 無効化は共有層の世代番号で全レプリカに伝わる
+@cached("user_passwords", ttl=600, local_only=True)
+def fetch_password_hashes_from_firestore():
+    """Firestoreから各ユーザーのパスワードハッシュを読み込み、{username: hash} の辞書を返す"""
+    users_docs = get_db().collection('users').select(['password']).stream()
+    password_hashes = {}
+    for doc in users_docs:
+        password = doc.to_dict().get('password')
+        if password is not None:
+            password_hashes[doc.id] = password
+    return password_hashes
+
 def fetch_config_from_firestore():
     """Firestoreからユーザー設定を読み込み、authenticatorが要求する形式に変換する"""
     try:
-        users_ref = db.collection('users')
-        users_docs = users_ref.stream()
-
-        usernames_dict = {}
-        for doc in users_docs:
-            user_data = doc.to_dict()
-            username = doc.id
-
-            # 基本的なユーザー情報を作成
-            user_entry = {
-                'email': user_data.get('email'),
-                'name': user_data.get('name'),
-                # これらはライブラリが実行時に管理
-                'logged_in': False,
-                'failed_login_attempts': 0
-            }
-
-            # passwordフィールドがFirestoreに存在する場合のみ、辞書に追加する
-            if 'password' in user_data and user_data['password'] is not None:
-                user_entry['password'] = user_data['password']
-
-            usernames_dict[username] = user_entry
+        usernames_dict = fetch_users_from_firestore()
+        password_hashes = fetch_password_hashes_from_firestore()
+        # passwordフィールドがFirestoreに存在するユーザーのみ、辞書に追加する
+        for username, password_hash in password_hashes.items():
+            if username in usernames_dict:
+                usernames_dict[username]['password'] = password_hash
 
         # --- 以下、変更なし ---
         config = {
@@ -139,20 +168,35 @@ def fetch_config_from_firestore():
 
 
 def add_or_update_user_in_firestore(username, name, email, password_hash=None):
-    """Firestoreに新規ユーザーを追加または既存ユーザーを更新する"""
+    """Firestoreに新規ユーザーを追加または既存ユーザーを更新する（内容が変わらない場合は何もしない）"""
     try:
-        user_ref = db.collection('users').document(username)
         user_data = {
             'name': name,
             'email': email
         }
         if password_hash:
             user_data['password'] = password_hash
-        
+
+        # ログイン後は画面の再実行のたびに呼ばれるため、キャッシュ済みのユーザー一覧と同じ内容であればFirestoreにアクセスしない
+        cached_entry = dict(fetch_users_from_firestore().get(username, {}))
+        if password_hash:
+            cached_entry['password'] = fetch_password_hashes_from_firestore().get(username)
+        if all(cached_entry.get(key) == value for key, value in user_data.items()):
+            return True
+        user_ref = get_db().collection('users').document(username)
+        current_data = user_ref.get().to_dict() or {}
+        changed = {key: value for key, value in user_data.items() if current_data.get(key) != value}
+        if not changed:
+            return True
+
         # merge=Trueで既存のフィールドを上書きせずにドキュメントを作成・更新
-        user_ref.set(user_data, merge=True)
+        user_ref.set(changed, merge=True)
         logging.info(f"User '{username}' data saved/updated in Firestore.")
-        st.cache_data.clear()
+        # 名前・メールアドレス・パスワードが実際に変わった場合だけ、レプリカ間で共有しているキャッシュを破棄する
+        if 'name' in changed or 'email' in changed:
+            get_cache().invalidate("user_config")
+        if 'password' in changed:
+            get_cache().invalidate("user_passwords")
         return True
     except Exception as e:
         logging.error(f"Failed to save/update user {username} in Firestore: {e}")
@@ -160,26 +204,25 @@ def add_or_update_user_in_firestore(username, name, email, password_hash=None):
 
 def save_api_keys_to_firestore(username, notion_key, gemini_key):
     """ユーザーのAPIキーを暗号化してFirestoreに保存"""
-    encrypted_notion = fernet.encrypt(notion_key.encode()).decode()
-    encrypted_gemini = fernet.encrypt(gemini_key.encode()).decode()
+    encrypted_notion = get_fernet().encrypt(notion_key.encode()).decode()
+    encrypted_gemini = get_fernet().encrypt(gemini_key.encode()).decode()
     
-    user_ref = db.collection('users').document(username)
+    user_ref = get_db().collection('users').document(username)
     user_ref.update({
         'notion_api_key': encrypted_notion,
         'gemini_api_key': encrypted_gemini
     })
     logging.info(f"API keys saved for user: {username}")
-    st.cache_data.clear()
 
 def load_api_keys_from_firestore(username):
     """FirestoreからユーザーのAPIキーを読み込み復号して返す"""
-    user_ref = db.collection('users').document(username)
+    user_ref = get_db().collection('users').document(username)
     user_doc = user_ref.get()
     if user_doc.exists:
         user_data = user_doc.to_dict()
         try:
-            decrypted_notion = fernet.decrypt(user_data['notion_api_key'].encode()).decode()
-            decrypted_gemini = fernet.decrypt(user_data['gemini_api_key'].encode()).decode()
+            decrypted_notion = get_fernet().decrypt(user_data['notion_api_key'].encode()).decode()
+            decrypted_gemini = get_fernet().decrypt(user_data['gemini_api_key'].encode()).decode()
             return {'notion': decrypted_notion, 'gemini': decrypted_gemini}
         except (KeyError, TypeError):
             return None
@@ -188,17 +231,53 @@ def load_api_keys_from_firestore(username):
 def update_password_in_firestore(username, new_hashed_password):
     """Firestoreのユーザーパスワードを更新する"""
     try:
-        user_ref = db.collection('users').document(username)
+        user_ref = get_db().collection('users').document(username)
         user_ref.update({
             'password': new_hashed_password
         })
         logging.info(f"Password updated successfully in Firestore for user: {username}")
-        st.cache_data.clear() # Clear cache to force re-fetch of config
+        get_cache().invalidate("user_passwords") # Clear cache to force re-fetch of password hashes
         return True
     except Exception as e:
         logging.error(f"Failed to update password in Firestore for user {username}: {e}")
         return False
 
+def create_notion_client(api_key):
+    """Notion APIの呼び出し回数を使用量として記録する、Notionクライアントを作成する"""
+    import httpx
+    import notion_client
+    return notion_client.Client(auth=api_key, client=httpx.Client(event_hooks=usage_meter.event_hooks('notion_calls')))
+
+def create_job_clients(username):
+    """バックグラウンドジョブ用に、Firestoreに保存されたAPIキーからクライアント群を作成する"""
+    api_keys = load_api_keys_from_firestore(username)
+    if not api_keys:
+        raise RuntimeError(f"APIキーが設定されていません: {username}")
+    # genai.configure() はプロセス全体のAPIキーを切り替えてしまうため、ユーザーのAPIキーに結び付いたモデルを作成する
+    gemini_lite_model = create_model(os.getenv("GEMINI_LITE_MODEL", "gemini-2.5-flash-lite"), api_keys['gemini'])
+    return SimpleNamespace(
+        notion_client=create_notion_client(api_keys['notion']),
+        gemini_model=create_model(os.getenv("GEMINI_MODEL", "gemini-2.5-flash"), api_keys['gemini'], fallback=gemini_lite_model),
+        gemini_lite_model=gemini_lite_model,
+        current_user=username,
+    )
+
+@st.cache_resource
+def start_job_workers():
+    """バックグラウンドジョブのワーカーをプロセスごとに1回だけ起動し、中断されたジョブを再開する"""
+    job_queue.start_workers(create_job_clients)
+    return True
+
+start_job_workers()
+
+@st.cache_resource
+def start_usage_meter():
+    """使用量の集計をプロセスごとに1回だけ開始する（Firestoreへの書き込みは一定間隔・実行の終了時にまとめて行う）"""
+    usage_meter.configure(usage_meter.FirestoreSink(get_db))
+    return True
+
+start_usage_meter()
+
 # --- メインアプリケーション ---
 # 設定取得
 config = fetch_config_from_firestore()
@@ -293,6 +372,8 @@ if st.session_state["authentication_status"]:
             st.error(e)
 
     user_api_keys = load_api_keys_from_firestore(st.session_state["username"])
+    # このスクリプト実行中のAPI呼び出しは、ログイン中のユーザーの使用量として記録する
+    usage_meter.set_current_user(st.session_state["username"])
 
     if not user_api_keys:
         st.warning("APIキーが設定されていません。サイドバーの「APIキー設定」から登録してください。")
@@ -304,12 +385,13 @@ if st.session_state["authentication_status"]:
     
     try:
         if st.session_state.get('current_user') != st.session_state["username"] or 'clients_initialized' not in st.session_state:
-            st.session_state.notion_client = notion_client.Client(auth=user_api_keys['notion'])
-            genai.configure(api_key=user_api_keys['gemini'])
+            st.session_state.notion_client = create_notion_client(user_api_keys['notion'])
             GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
             GEMINI_LITE_MODEL_NAME = os.getenv("GEMINI_LITE_MODEL", "gemini-2.5-flash-lite")
-            st.session_state.gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-            st.session_state.gemini_lite_model = genai.GenerativeModel(GEMINI_LITE_MODEL_NAME)
+            # レート制限・リトライ・クォータ切れ時のLiteモデルへの切り替えは GovernedModel が担当する（create_model がラップする）
+            # 同じプロセスの他のセッション・バックグラウンドジョブのAPIキーを切り替えないよう、genai.configure() は使わない
+            st.session_state.gemini_lite_model = create_model(GEMINI_LITE_MODEL_NAME, user_api_keys['gemini'])
+            st.session_state.gemini_model = create_model(GEMINI_MODEL_NAME, user_api_keys['gemini'], fallback=st.session_state.gemini_lite_model)
             st.session_state.notion_client.users.me()
             st.session_state.clients_initialized = True
             st.session_state.current_user = st.session_state["username"]
@@ -318,6 +400,72 @@ if st.session_state["authentication_status"]:
         st.error(f"APIクライアントの初期化中にエラーが発生しました。APIキーが正しいか確認してください。\n\nエラー詳細: {e}")
         st.stop()
     
+    # --- バックグラウンドジョブの進捗表示 ---
+    @st.fragment(run_every=5)
+    def show_background_jobs():
+        jobs = job_queue.list_jobs(st.session_state["username"], limit=10)
+        if not jobs:
+            st.caption("登録されたジョブはありません。")
+            return
+        status_icons = {'queued': '⏳', 'running': '🔄', 'succeeded': '✅', 'failed': '❌'}
+        for job in jobs:
+            kind_label = {'new': "新規作成", 'patch': "差分修正"}.get(job['kind'], "編集・追記")
+            st.markdown(f"{status_icons.get(job['status'], '・')} `{job['id']}` {kind_label}")
+            if job['progress']:
+                st.caption(job['progress'])
+
+    with st.sidebar.expander("バックグラウンドジョブ"):
+        show_background_jobs()
+
+    # --- 今月の使用量 ---
+    with st.sidebar.expander("今月の使用量"):
+        usage_status = usage_meter.get_meter().usage(st.session_state["username"])
+        for metric, label in usage_meter.METRIC_LABELS.items():
+            limit = usage_status['quotas'].get(metric)
+            used = usage_status['usage'].get(metric, 0)
+            st.caption(f"{label}: {used:,}" + (f" / {limit:,}" if limit else ""))
+
+    # --- 実行プロファイル（遅い実行の調査用。管理者または RUN_PROFILER_ENABLED の場合のみ表示） ---
+    if run_profiler.is_admin(st.session_state["username"]) or run_profiler.RUN_PROFILER_ENABLED:
+        with st.sidebar.expander("実行プロファイル"):
+            if run_profiler.is_admin(st.session_state["username"]):
+                st.checkbox("このセッションの実行をプロファイルする", key="profile_runs", help="CPUプロファイルとメモリ割り当て（tracemalloc）を記録します。実行が遅くなる場合があります。")
+            # 管理者はすべてのユーザーの実行を、それ以外のユーザーは自分の実行だけを確認できる
+            profile_owner = None if run_profiler.is_admin(st.session_state["username"]) else st.session_state["username"]
+            profile_runs = run_profiler.list_runs(profile_owner)
+            if not profile_runs:
+                st.caption("保存されたプロファイルはありません。")
+            else:
+                profile_options = {r['run_id']: f"{r['run_id']} {r['kind']} ({r['username']}, {r['wall_seconds']:.1f}秒)" for r in profile_runs}
+                selected_run_id = st.selectbox("プロファイル:", options=profile_options.keys(), format_func=lambda x: profile_options[x])
+                profile_summary = next(r for r in profile_runs if r['run_id'] == selected_run_id)
+                st.caption(f"経過時間 {profile_summary['wall_seconds']:.2f}秒 / CPU時間 {profile_summary['cpu_seconds']:.2f}秒 / メモリのピーク {profile_summary['peak_mib']:.1f} MiB")
+                if profile_summary['memory_shared']:
+                    st.caption("※ 同時に別の実行もプロファイルしていたため、メモリの数値にはその分も含まれます。")
+                st.markdown("**累積時間の長い関数**")
+                st.dataframe(profile_summary['top_functions'], use_container_width=True)
+                st.markdown("**メモリ割り当ての多い箇所**")
+                st.dataframe(profile_summary['top_allocations'], use_container_width=True)
+                if os.path.exists(run_profiler.profile_path(selected_run_id)):
+                    with open(run_profiler.profile_path(selected_run_id), "rb") as f:
+                        st.download_button("pstats形式でダウンロード", f.read(), file_name=f"{selected_run_id}.prof")
+
+    # --- Notionワークスペースの索引（参考情報のローカル検索用） ---
+    with st.sidebar.expander("Notionワークスペースの索引"):
+        st.caption(f"索引済みページ: {notion_index.page_count(st.session_state.notion_client)}件")
+        full_resync = st.checkbox("索引を作り直す（削除・アーカイブされたページを反映）", key="index_full_resync")
+        if st.button("索引を同期する"):
+            progress_bar = st.progress(0.0, text="変更されたページを確認しています...")
+            def report_index_progress(done, total):
+                progress_bar.progress(done / total, text=f"ページを取り込んでいます... ({done}/{total})")
+            try:
+                updated = notion_index.sync(st.session_state.notion_client, full=full_resync, progress=report_index_progress)
+                progress_bar.empty()
+                st.success(f"{updated}件のページを索引に反映しました。")
+            except Exception as e:
+                progress_bar.empty()
+                st.error(f"索引の同期中にエラーが発生しました: {e}")
+
     # (メインUIの残り... 省略)
     with st.spinner("データベースを読み込んでいます..."):
         databases = get_all_databases(st.session_state.notion_client)
@@ -328,7 +476,7 @@ if st.session_state["authentication_status"]:
 
     db_options = {db['id']: db['title'] for db in databases}
     selected_db_id = st.selectbox("1. 操作するNotionデータベースを選択してください", options=db_options.keys(), format_func=lambda x: db_options[x])
-    mode = st.radio("2. 実行する操作を選択してください", ("新しいページを作成する", "既存のページを編集・追記する"), horizontal=True)
+    mode = st.radio("2. 実行する操作を選択してください", ("新しいページを作成する", "既存のページを編集・追記する", "複数のページを一括で追記する"), horizontal=True)
     st.markdown("---")
 
     persona_options = {
@@ -360,9 +508,10 @@ if st.session_state["authentication_status"]:
                 ai_persona = persona_options[selected_persona_key]
 
             st.markdown("##### 2. 参考資料とWeb検索設定")
-            st.markdown("<small>※ ファイル > 単一URL > Web検索 の優先順位で情報源として利用します。</small>", unsafe_allow_html=True)
+            st.markdown("<small>※ ファイル > 単一URL > Notion索引 > Web検索 の優先順位で情報源として利用します。</small>", unsafe_allow_html=True)
             uploaded_files = st.file_uploader("参考ドキュメント (PDF/Word/Text):", type=['pdf', 'docx', 'txt'], accept_multiple_files=True)
             source_url = st.text_input("参考URL (上記ファイルがない場合):", placeholder="https://example.com/article")
+            use_notion_index = st.checkbox("Notionワークスペースの索引から参考情報を探す", help="サイドバーで同期した索引から関連ページを検索します。見つからない場合はWeb検索を行います。")
             
             col1, col2 = st.columns(2)
             with col1:
@@ -379,9 +528,13 @@ if st.session_state["authentication_status"]:
                 user_prompt_new = prompt_templates[selected_template_key]
                 topic_new = st.text_area("具体的なテーマやキーワードを入力してください:", placeholder="例：最新のAI技術")
 
+            long_form = st.checkbox("長文モード（アウトラインを作成し、セクションごとに並列で生成する）", help="長いガイド記事などで生成時間を短縮します。完成したセクションから順にNotionへ書き込みます。")
+            regenerate_new = st.checkbox("キャッシュを使わずに再生成する", help="同じ内容で送信した場合、通常は前回の生成結果を再利用します。")
+            run_in_background_new = st.checkbox("バックグラウンドで実行する", help="画面を操作したりページを離れたりしても生成を継続します。進捗はサイドバーの「バックグラウンドジョブ」で確認できます。")
             submitted_new = st.form_submit_button("記事を生成する", type="primary")
 
         if submitted_new:
+            quota_message = usage_meter.get_meter().check_quota(st.session_state["username"])
             if selected_template_key != "カスタム":
                 final_prompt_new = user_prompt_new.format(topic=topic_new)
             else:
@@ -390,10 +543,23 @@ if st.session_state["authentication_status"]:
                 st.warning("作業内容とテーマの両方を入力してください。")
             elif not ai_persona:
                  st.warning("AIのペルソナを入力してください。")
+            elif quota_message:
+                st.error(f"今月の使用量の上限に達しています: {quota_message}")
+            elif run_in_background_new:
+                job_id = job_queue.submit(st.session_state["username"], 'new', {
+                    'database_id': selected_db_id, 'user_prompt': final_prompt_new, 'ai_persona': ai_persona,
+                    'source_url': source_url, 'search_count': search_count, 'full_text_token_limit': full_text_token_limit,
+                    'regenerate': regenerate_new, 'use_notion_index': use_notion_index, 'long_form': long_form,
+                }, uploaded_files)
+                st.success(f"ジョブ `{job_id}` を登録しました。進捗はサイドバーの「バックグラウンドジョブ」で確認できます。")
             else:
                 status_placeholder = st.empty()
                 results_placeholder = st.empty()
-                run_new_page_process(selected_db_id, final_prompt_new, ai_persona, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder)
+                with usage_meter.metered_run(st.session_state["username"]), \
+                        run_profiler.profiled_run('new', st.session_state["username"], enabled=run_profiler.is_enabled(st.session_state.get('profile_runs', False))) as profile:
+                    run_new_page_process(selected_db_id, final_prompt_new, ai_persona, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder, regenerate=regenerate_new, use_notion_index=use_notion_index, long_form=long_form)
+                if profile['run_id']:
+                    st.caption(f"🩺 この実行のプロファイルを保存しました: `{profile['run_id']}`（サイドバーの「実行プロファイル」で確認できます）")
 
     elif mode == "既存のページを編集・追記する":
         st.subheader("既存のページを編集・追記")
@@ -431,9 +597,13 @@ if st.session_state["authentication_status"]:
                     user_prompt_edit = prompt_templates[selected_template_key_edit]
                     topic_edit = st.text_area("具体的なテーマやキーワードを入力してください:", placeholder="例：ビジネスでの具体的な活用事例")
 
+                edit_method = st.radio("編集方法:", ("末尾に追記する", "既存のブロックを差分で修正する"), horizontal=True, help="差分で修正する場合、変更が必要なブロックだけを更新・挿入・削除し、それ以外のブロックはそのまま残します。")
+                regenerate_edit = st.checkbox("キャッシュを使わずに再生成する", help="同じ内容で送信した場合、通常は前回の生成結果を再利用します。", key="regenerate_edit")
+                run_in_background_edit = st.checkbox("バックグラウンドで実行する", help="画面を操作したりページを離れたりしても生成を継続します。進捗はサイドバーの「バックグラウンドジョブ」で確認できます。", key="background_edit")
                 submitted_edit = st.form_submit_button("編集・追記を実行する", type="primary")
 
             if submitted_edit:
+                quota_message = usage_meter.get_meter().check_quota(st.session_state["username"])
                 if selected_template_key_edit != "カスタム":
                     final_prompt_edit = user_prompt_edit.format(topic=topic_edit)
                 else:
@@ -443,10 +613,74 @@ if st.session_state["authentication_status"]:
                     st.warning("作業内容とテーマの両方を入力してください。")
                 elif not ai_persona_edit:
                     st.warning("AIのペルソナを入力してください。")
+                elif quota_message:
+                    st.error(f"今月の使用量の上限に達しています: {quota_message}")
+                elif run_in_background_edit:
+                    job_kind = 'patch' if edit_method == "既存のブロックを差分で修正する" else 'edit'
+                    job_id = job_queue.submit(st.session_state["username"], job_kind, {
+                        'page_id': selected_page_id, 'user_prompt': final_prompt_edit, 'ai_persona': ai_persona_edit,
+                        'source_url': source_url_edit, 'search_count': search_count_edit, 'full_text_token_limit': full_text_token_limit_edit,
+                        'regenerate': regenerate_edit,
+                    }, uploaded_files_edit)
+                    st.success(f"ジョブ `{job_id}` を登録しました。進捗はサイドバーの「バックグラウンドジョブ」で確認できます。")
                 else:
                     status_placeholder = st.empty()
                     results_placeholder = st.empty()
-                    run_edit_page_process(selected_page_id, final_prompt_edit, ai_persona_edit, uploaded_files_edit, source_url_edit, search_count_edit, full_text_token_limit_edit, status_placeholder, results_placeholder)
+                    run_edit = run_patch_page_process if edit_method == "既存のブロックを差分で修正する" else run_edit_page_process
+                    with usage_meter.metered_run(st.session_state["username"]), \
+                            run_profiler.profiled_run('patch' if run_edit is run_patch_page_process else 'edit', st.session_state["username"], enabled=run_profiler.is_enabled(st.session_state.get('profile_runs', False))) as profile:
+                        run_edit(selected_page_id, final_prompt_edit, ai_persona_edit, uploaded_files_edit, source_url_edit, search_count_edit, full_text_token_limit_edit, status_placeholder, results_placeholder, regenerate=regenerate_edit)
+                    if profile['run_id']:
+                        st.caption(f"🩺 この実行のプロファイルを保存しました: `{profile['run_id']}`（サイドバーの「実行プロファイル」で確認できます）")
+
+    elif mode == "複数のページを一括で追記する":
+        st.subheader("複数のページに一括で追記")
+        st.caption("条件に一致するページそれぞれに、同じ指示で生成した文章を追記します。参考情報は1回だけ収集して全ページで共有します。ページのタイトルは変更しません。")
+        with st.form("bulk_edit_form"):
+            st.markdown("##### 1. 対象ページの条件")
+            col1_bulk, col2_bulk, col3_bulk = st.columns(3)
+            with col1_bulk:
+                title_filter_bulk = st.text_input("タイトルに含まれる文字列（空欄で全ページ）:", key="title_filter_bulk")
+            with col2_bulk:
+                max_pages_bulk = st.number_input("最大ページ数:", min_value=1, max_value=500, value=50, key="max_pages_bulk")
+            with col3_bulk:
+                concurrency_bulk = st.slider("同時実行数:", min_value=1, max_value=8, value=4, help="NotionとGeminiの呼び出しは、この値に関係なくレート制限の範囲内に抑えられます。", key="concurrency_bulk")
+
+            st.markdown("##### 2. AIの役割（ペルソナ）を選択")
+            selected_persona_key_bulk = st.selectbox("AIのペルソナ:", options=persona_options.keys(), key="persona_bulk", label_visibility="collapsed")
+            if selected_persona_key_bulk == "カスタム":
+                ai_persona_bulk = st.text_input("AIの具体的な役割を入力:", key="custom_persona_bulk")
+            else:
+                ai_persona_bulk = persona_options[selected_persona_key_bulk]
+
+            st.markdown("##### 3. 参考資料とWeb検索設定")
+            st.markdown("<small>※ ファイル > 単一URL > Web検索 の優先順位で情報源として利用します。</small>", unsafe_allow_html=True)
+            uploaded_files_bulk = st.file_uploader("参考ドキュメント (PDF/Word/Text):", type=['pdf', 'docx', 'txt'], accept_multiple_files=True, key="uploader_bulk")
+            source_url_bulk = st.text_input("参考URL (上記ファイルがない場合):", placeholder="https://example.com/article", key="source_url_bulk")
+            col4_bulk, col5_bulk = st.columns(2)
+            with col4_bulk:
+                search_count_bulk = st.slider("Web検索数（件）:", min_value=1, max_value=15, value=5, help="参考資料がない場合にWeb検索する最大記事数。", key="slider_bulk")
+            with col5_bulk:
+                full_text_token_limit_bulk = st.slider("全文取得のトークン上限:", min_value=5000, max_value=150000, value=20000, step=5000, help="このトークン数までは記事の全文を使います。超えた分は要約されます。", key="slider_token_bulk")
+
+            st.markdown("##### 4. AIへの指示")
+            user_prompt_bulk = st.text_area("各ページに追記する内容の指示を入力してください:", placeholder="例：このページの内容に基づいて「よくある質問（FAQ）」セクションを追加してください。", key="prompt_bulk")
+
+            submitted_bulk = st.form_submit_button("一括追記を実行する", type="primary")
+
+        if submitted_bulk:
+            quota_message = usage_meter.get_meter().check_quota(st.session_state["username"])
+            if not user_prompt_bulk:
+                st.warning("AIへの指示を入力してください。")
+            elif not ai_persona_bulk:
+                st.warning("AIのペルソナを入力してください。")
+            elif quota_message:
+                st.error(f"今月の使用量の上限に達しています: {quota_message}")
+            else:
+                status_placeholder = st.empty()
+                results_placeholder = st.empty()
+                with usage_meter.metered_run(st.session_state["username"]):
+                    run_bulk_edit_process(selected_db_id, title_filter_bulk, int(max_pages_bulk), concurrency_bulk, user_prompt_bulk, ai_persona_bulk, uploaded_files_bulk, source_url_bulk, search_count_bulk, full_text_token_limit_bulk, status_placeholder, results_placeholder)
 
 elif st.session_state["authentication_status"] is False:
     st.error('ユーザー名かパスワードが間違っています')
@@ -0,0 +1,104 @@
+"""起動時のimport時間を計測するベンチマーク。
+
+app.py がトップレベルでimportするモジュール（＝ログインフォーム表示までに必ず読み込まれるもの）と、
+遅延読み込みにしている重い依存ライブラリを、それぞれ新しいPythonプロセスで -X importtime 付きで計測します。
+
+    python bench_startup.py              # 結果を表示
+    python bench_startup.py --budget-ms 1500   # 起動時importの合計が予算を超えたら終了コード1
+"""
+import argparse
+import ast
+import os
+import subprocess
+import sys
+
+# 実際のコードパスで必要になった時だけ読み込む重い依存ライブラリ
+LAZY_MODULES = [
+    "google.generativeai",
+    "firebase_admin.firestore",
+    "notion_client",
+    "trafilatura",
+    "pdfplumber",
+    "docx",
+    "ddgs",
+    "httpx",
+    "cryptography.fernet",
+]
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+def startup_modules(path: str = APP_PATH) -> list:
+    """app.py のトップレベルのimport文から、起動時に読み込まれるモジュール名を列挙します。"""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def measure_import(modules: list):
+    """新しいプロセスで modules をまとめてimportし、(合計マイクロ秒, {モジュール名: 累積マイクロ秒}) を返します。
+
+    importに失敗した場合は (None, エラーメッセージ) を返します。
+    """
+    code = "; ".join(f"import {name}" for name in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, cwd=os.path.dirname(APP_PATH),
+    )
+    if result.returncode != 0:
+        last_line = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "unknown error"
+        return None, last_line
+    cumulative = {}
+    top_level_total = 0
+    entries = []
+    for line in result.stderr.splitlines():
+        # 形式: "import time: self [us] | cumulative | imported package"（ネストはパッケージ名のインデントで表される）
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, raw_name = line[len("import time:"):].split("|", 2)
+        entries.append((len(raw_name) - len(raw_name.lstrip()), raw_name.strip(), int(cumulative_us)))
+    if entries:
+        min_indent = min(indent for indent, _, _ in entries)
+        for indent, name, us in entries:
+            cumulative[name] = us
+            if indent == min_indent:
+                top_level_total += us
+    return top_level_total, {name: cumulative[name] for name in modules if name in cumulative}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="起動時のimport時間を計測します。")
+    parser.add_argument("--budget-ms", type=float, default=None, help="起動時importの合計時間の予算（ミリ秒）")
+    args = parser.parse_args()
+
+    modules = startup_modules()
+    print("== 起動時に読み込まれるモジュール (app.py のトップレベルimport) ==")
+    total, detail = measure_import(modules)
+    if total is None:
+        print(f"  計測できませんでした: {detail}")
+    else:
+        for name, us in sorted(detail.items(), key=lambda item: -item[1]):
+            print(f"  {us / 1000:9.1f} ms  {name}")
+        print(f"  {total / 1000:9.1f} ms  合計")
+
+    print("\n== 遅延読み込みしている依存ライブラリ (単独でimportした場合) ==")
+    for name in LAZY_MODULES:
+        lazy_total, lazy_detail = measure_import([name])
+        if lazy_total is None:
+            print(f"  {'-':>9}     {name} (未インストール: {lazy_detail})")
+        else:
+            print(f"  {lazy_total / 1000:9.1f} ms  {name}")
+
+    if args.budget_ms is not None and total is not None and total / 1000 > args.budget_ms:
+        print(f"\n起動時importの合計 {total / 1000:.1f} ms が予算 {args.budget_ms:.1f} ms を超えています。")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import re
+from difflib import SequenceMatcher
+
+from notion_utils import notion_blocks_to_markdown, markdown_to_notion_blocks
+
+# rich_text をその場で更新できるブロックの種類
+UPDATABLE_TYPES = {
+    'paragraph', 'heading_1', 'heading_2', 'heading_3', 'quote',
+    'bulleted_list_item', 'numbered_list_item', 'to_do', 'code',
+}
+# Markdownとの相互変換に対応しているブロックの種類（それ以外の画像などは編集対象にせず、常に残す）
+EDITABLE_TYPES = UPDATABLE_TYPES | {'divider', 'table'}
+
+_PATCH_HEADER = re.compile(r"^@@\s*(replace|insert_after|delete)\s+(\d+)(?:\s*-\s*(\d+))?\s*@*\s*$")
+
+
+def _rich_text_key(rich_text: list) -> tuple:
+    return tuple(
+        (rt.get('plain_text') or rt.get('text', {}).get('content', ''),
+         tuple(sorted(k for k, v in rt.get('annotations', {}).items() if v is True)))
+        for rt in rich_text
+    )
+
+
+def content_signature(block: dict) -> tuple:
+    """ブロックの種類と内容から、比較用のシグネチャを返します。"""
+    block_type = block['type']
+    body = block.get(block_type, {})
+    if block_type == 'table':
+        rows = body.get('children', [])
+        return (block_type, tuple(tuple(_rich_text_key(cell) for cell in row['table_row']['cells']) for row in rows))
+    return (block_type, _rich_text_key(body.get('rich_text', [])), body.get('checked'), body.get('language'))
+
+
+def snapshot_page(blocks: list, _notion_client) -> list:
+    """ページ直下のブロックを、番号・Markdown・シグネチャ付きの項目のリストに変換します。
+
+    既存ブロックのシグネチャはMarkdownを経由して作り直したブロックから計算するため、
+    変更されていないブロックは（リンクや色などMarkdownで表せない装飾があっても）新しい内容と一致します。
+    """
+    items = []
+    for number, block in enumerate(blocks, start=1):
+        editable = block['type'] in EDITABLE_TYPES
+        markdown = notion_blocks_to_markdown([block], _notion_client).strip() if editable else ""
+        converted = markdown_to_notion_blocks(markdown) if editable else []
+        if len(converted) == 1 and converted[0]['type'] == block['type']:
+            signature = content_signature(converted[0])
+        else:
+            signature = ('block', block['id'])
+        items.append({
+            'number': number, 'id': block['id'], 'type': block['type'],
+            'markdown': markdown, 'signature': signature, 'editable': editable,
+        })
+    return items
+
+
+def render_numbered(items: list) -> str:
+    """AIに渡すための、番号付きのページ内容を返します。"""
+    lines = []
+    for item in items:
+        if item['editable']:
+            lines.append(f"[{item['number']}]\n{item['markdown']}")
+        else:
+            lines.append(f"[{item['number']}] （編集できないブロック: {item['type']}）")
+    return "\n".join(lines)
+
+
+def parse_patch(text: str) -> list:
+    """AIが出力した差分を (操作, 開始番号, 終了番号, 本文) のリストに変換します。"""
+    operations = []
+    current = None
+    body = []
+    for line in text.splitlines():
+        match = _PATCH_HEADER.match(line.strip())
+        if match:
+            if current:
+                operations.append((*current, "\n".join(body).strip()))
+            start = int(match.group(2))
+            current = (match.group(1), start, int(match.group(3) or start))
+            body = []
+        elif current:
+            body.append(line)
+    if current:
+        operations.append((*current, "\n".join(body).strip()))
+    return operations
+
+
+def apply_patch(items: list, operations: list):
+    """差分を既存の項目に適用し、(新しい並び, 無視した操作の説明のリスト) を返します。
+
+    新しい並びは ('old', 項目) または ('new', ブロック) のタプルのリストです。編集できないブロックは常に残します。
+    """
+    by_number = {item['number']: item for item in items}
+    removed = set()
+    replacements = {}
+    inserts = {}
+    ignored = []
+    for op, start, end, body in operations:
+        valid_range = (op == 'insert_after' and start in by_number.keys() | {0}) or (
+            op != 'insert_after' and start <= end and all(n in by_number for n in range(start, end + 1))
+        )
+        if not valid_range:
+            ignored.append(f"{op} {start}-{end}（存在しないブロック番号）")
+            continue
+        if op == 'insert_after':
+            inserts.setdefault(start, []).extend(markdown_to_notion_blocks(body))
+            continue
+        targets = [n for n in range(start, end + 1) if by_number[n]['editable']]
+        if len(targets) != end - start + 1:
+            ignored.append(f"{op} {start}-{end}（編集できないブロックは変更しません）")
+        removed.update(targets)
+        if op == 'replace' and targets:
+            replacements[targets[0]] = markdown_to_notion_blocks(body)
+
+    sequence = [('new', block) for block in inserts.get(0, [])]
+    for item in items:
+        number = item['number']
+        if number in replacements:
+            sequence.extend(('new', block) for block in replacements[number])
+        if number not in removed:
+            sequence.append(('old', item))
+        sequence.extend(('new', block) for block in inserts.get(number, []))
+    return sequence, ignored
+
+
+def plan_operations(items: list, sequence: list) -> list:
+    """既存の項目と新しい並びから、最小限のブロック操作のリストを計算します。
+
+    操作は順番に ('keep', 項目) / ('update', 項目, ブロック) / ('delete', 項目) / ('insert', [ブロック]) です。
+    """
+    old_signatures = [item['signature'] for item in items]
+    new_signatures = [entry[1]['signature'] if entry[0] == 'old' else content_signature(entry[1]) for entry in sequence]
+    operations = []
+
+    def insert(blocks):
+        if operations and operations[-1][0] == 'insert':
+            operations[-1][1].extend(blocks)
+        else:
+            operations.append(('insert', list(blocks)))
+
+    matcher = SequenceMatcher(None, old_signatures, new_signatures, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        old_items = items[i1:i2]
+        new_entries = sequence[j1:j2]
+        if tag == 'equal':
+            operations.extend(('keep', item) for item in old_items)
+            continue
+        for k in range(max(len(old_items), len(new_entries))):
+            item = old_items[k] if k < len(old_items) else None
+            entry = new_entries[k] if k < len(new_entries) else None
+            new_block = entry[1] if entry and entry[0] == 'new' else None
+            if item and new_block and item['type'] == new_block['type'] and item['type'] in UPDATABLE_TYPES:
+                operations.append(('update', item, new_block))
+                continue
+            if item:
+                operations.append(('keep', item) if not item['editable'] else ('delete', item))
+            if new_block:
+                insert([new_block])
+    return operations
+
+
+def execute_operations(_notion_client, page_id: str, operations: list, resume: dict = None, on_progress=None) -> dict:
+    """ブロック操作をNotionに反映し、操作ごとの件数を返します。
+
+    Notion APIは「あるブロックの後ろ」にしか挿入できないため、先頭への挿入は最初に残るブロックの直後に行います。
+    on_progress には、Notionへの書き込みのたびに反映済みの位置を表す辞書が渡されます。
+    その辞書を resume に渡すと、反映済みの操作を繰り返さずに続きから反映します。
+    """
+    resume = resume or {}
+    stats = dict(resume.get('stats') or {'update': 0, 'insert': 0, 'delete': 0, 'keep': 0, 'moved_from_top': False})
+    anchor = resume.get('anchor')
+    # 先頭への挿入を最初に残るブロックの直後へ移した場合の [そのブロックのID, 挿入した最後のブロックのID]。
+    # そのブロックの keep / update を処理した時点で、以降の挿入は移したブロックの後ろに行う
+    moved = resume.get('moved')
+    start = resume.get('index', 0)
+
+    def report(index, offset=0, after=None):
+        if on_progress:
+            on_progress({'index': index, 'offset': offset, 'after': after, 'anchor': anchor, 'moved': moved, 'stats': stats})
+
+    def settle(block_id):
+        nonlocal moved
+        if moved and moved[0] == block_id:
+            block_id = moved[1]
+            moved = None
+        return block_id
+
+    for index in range(start, len(operations)):
+        operation = operations[index]
+        kind = operation[0]
+        if kind == 'keep':
+            anchor = settle(operation[1]['id'])
+        elif kind == 'update':
+            item, block = operation[1], operation[2]
+            _notion_client.blocks.update(block_id=item['id'], **{block['type']: block[block['type']]})
+            anchor = settle(item['id'])
+        elif kind == 'delete':
+            _notion_client.blocks.delete(block_id=operation[1]['id'])
+        elif kind == 'insert':
+            blocks = operation[1]
+            offset = resume.get('offset', 0) if index == start else 0
+            if offset:
+                after = resume.get('after')
+            else:
+                after = anchor
+                if after is None and moved:
+                    # 先頭への挿入が続く場合は、先に移したブロックの後ろに続ける
+                    after = moved[1]
+                elif after is None:
+                    survivor = next((op[1]['id'] for op in operations[index + 1:] if op[0] in ('keep', 'update')), None)
+                    if survivor:
+                        stats['moved_from_top'] = True
+                        after = survivor
+                        moved = [survivor, survivor]
+            for i in range(offset, len(blocks), 100):
+                kwargs = {'block_id': page_id, 'children': blocks[i:i + 100]}
+                if after:
+                    kwargs['after'] = after
+                response = _notion_client.blocks.children.append(**kwargs)
+                results = response.get('results', [])
+                if results:
+                    after = results[-1]['id']
+                if moved and anchor is None:
+                    moved[1] = after
+                if i + 100 < len(blocks):
+                    report(index, i + 100, after)
+            if anchor is not None:
+                anchor = after
+        stats[kind] += len(operation[1]) if kind == 'insert' else 1
+        if kind != 'keep':
+            report(index + 1)
+    return stats
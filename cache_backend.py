@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import logging
+import functools
+import threading
+import contextlib
+from collections import OrderedDict
+
+# --- 共有キャッシュの設定 (環境変数で上書き可能) ---
+# redis:// で始まるURLを指定するとRedis互換サーバーを共有層に使い、未指定ならローカルのSQLiteファイルを使う
+# （Redisを使う場合のみ、requirements.txt とは別に `pip install redis` が必要）
+CACHE_BACKEND_URL = os.getenv("CACHE_BACKEND_URL", "")
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "cache.sqlite3")
+CACHE_KEY_PREFIX = os.getenv("CACHE_KEY_PREFIX", "notion_ai")
+CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("CACHE_LOCAL_MAX_ENTRIES", "512"))
+# 他プロセスでの無効化を確認する間隔（秒）。この間はローカルの世代番号を信用する
+CACHE_INVALIDATION_CHECK_INTERVAL = float(os.getenv("CACHE_INVALIDATION_CHECK_INTERVAL", "2.0"))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class SQLiteTier:
+    """同一ホスト上のプロセス間で共有する、SQLiteファイルによるキャッシュ層。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # ユーザーのメールアドレスなども入るため、新しく作るファイルは所有者だけが読み書きできるようにする
+        # （SQLiteは -wal / -shm ファイルにも同じパーミッションを使う）
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, value, time.time() + ttl))
+            # 期限切れの行はときどき掃除する
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+    def incr(self, key: str) -> int:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO cache (key, value, expires_at) VALUES (?, '1', NULL) "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+                (key,),
+            )
+            return int(conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()[0])
+
+
+class RedisTier:
+    """Redisプロトコル互換サーバーによるキャッシュ層。
+
+    redis-py 互換のクライアント（get / set(ex=) / incr を持つもの）であれば何でも渡せます。
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError(
+                "CACHE_BACKEND_URL にRedisのURLが指定されていますが、redis パッケージがインストールされていません。"
+                "`pip install redis` を実行するか、CACHE_BACKEND_URL を未設定にしてSQLiteのキャッシュを使ってください。"
+            ) from e
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key: str):
+        value = self.client.get(key)
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key: str, value: str, ttl: float):
+        self.client.set(key, value, ex=max(1, int(ttl)))
+
+    def incr(self, key: str) -> int:
+        return int(self.client.incr(key))
+
+
+class TieredCache:
+    """プロセス内LRU（前段）と共有層（後段）を組み合わせた、名前空間付きのキャッシュ。
+
+    名前空間ごとの世代番号を共有層に置き、invalidate() で世代を進めることで全プロセスのキャッシュを無効化します。
+    """
+
+    def __init__(self, shared, max_entries: int = CACHE_LOCAL_MAX_ENTRIES, check_interval: float = CACHE_INVALIDATION_CHECK_INTERVAL):
+        self.shared = shared
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self._front = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def _generation(self, namespace: str) -> str:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._generations.get(namespace)
+            if cached and cached[0] > now:
+                return cached[1]
+        try:
+            generation = self.shared.get(f"{CACHE_KEY_PREFIX}:{namespace}:__generation__") or "0"
+        except Exception as e:
+            logging.warning(f"Shared cache read failed: {e}")
+            generation = "0"
+        with self._lock:
+            self._generations[namespace] = (now + self.check_interval, generation)
+        return generation
+
+    def _full_key(self, namespace: str, key: str) -> str:
+        return f"{CACHE_KEY_PREFIX}:{namespace}:g{self._generation(namespace)}:{key}"
+
+    def get(self, namespace: str, key: str):
+        """(ヒットしたかどうか, 値) のタプルを返します。値は呼び出しごとに新しいオブジェクトです。"""
+        full_key = self._full_key(namespace, key)
+        now = time.time()
+        with self._lock:
+            item = self._front.get(full_key)
+            if item is not None:
+                if item[0] > now:
+                    self._front.move_to_end(full_key)
+                    return True, json.loads(item[1])
+                del self._front[full_key]
+        try:
+            payload = self.shared.get(full_key)
+        except Exception as e:
+            logging.warning(f"Shared cache read failed: {e}")
+            payload = None
+        if payload is None:
+            return False, None
+        record = json.loads(payload)
+        self._remember(full_key, record['expires_at'], json.dumps(record['value'], ensure_ascii=False))
+        return True, record['value']
+
+    def set(self, namespace: str, key: str, value, ttl: float, local_only: bool = False):
+        """値を保存します。local_only=True の場合はプロセス内LRUにだけ置き、共有層には書き込みません。"""
+        full_key = self._full_key(namespace, key)
+        expires_at = time.time() + ttl
+        serialized = json.dumps(value, ensure_ascii=False)
+        self._remember(full_key, expires_at, serialized)
+        if local_only:
+            return
+        try:
+            self.shared.set(full_key, json.dumps({'expires_at': expires_at, 'value': value}, ensure_ascii=False), ttl)
+        except Exception as e:
+            logging.warning(f"Shared cache write failed: {e}")
+
+    def invalidate(self, namespace: str):
+        """名前空間のキャッシュを全プロセスで無効化します。"""
+        generation = self.shared.incr(f"{CACHE_KEY_PREFIX}:{namespace}:__generation__")
+        with self._lock:
+            self._generations[namespace] = (time.monotonic() + self.check_interval, str(generation))
+
+    def _remember(self, full_key: str, expires_at: float, serialized: str):
+        with self._lock:
+            self._front[full_key] = (expires_at, serialized)
+            self._front.move_to_end(full_key)
+            while len(self._front) > self.max_entries:
+                self._front.popitem(last=False)
+
+
+def get_cache() -> TieredCache:
+    """プロセス全体で共有するキャッシュを返します。"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if CACHE_BACKEND_URL.startswith(("redis://", "rediss://")):
+                    shared = RedisTier.from_url(CACHE_BACKEND_URL)
+                else:
+                    shared = SQLiteTier(CACHE_DB_PATH)
+                _cache = TieredCache(shared)
+    return _cache
+
+
+def make_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def cached(namespace: str, ttl: float, key_func=None, local_only: bool = False):
+    """関数の戻り値を共有キャッシュに保存するデコレーター。
+
+    key_func を省略した場合は、先頭が「_」でない引数からキーを作ります（st.cache_data と同じ規則）。
+    None はエラー時の戻り値として使われるためキャッシュしません。戻り値はJSONで表現できる必要があります。
+    local_only=True の場合、値は共有層に書き込まずプロセス内にだけ保持しますが、invalidate() は他プロセスにも伝わります。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if key_func is not None:
+                key = key_func(*args, **kwargs)
+            else:
+                names = func.__code__.co_varnames[:func.__code__.co_argcount]
+                bound = dict(zip(names, args), **kwargs)
+                key = make_key(*(v for k, v in sorted(bound.items()) if not k.startswith('_')))
+            cache = get_cache()
+            hit, value = cache.get(namespace, key)
+            if hit:
+                return value
+            value = func(*args, **kwargs)
+            if value is not None:
+                cache.set(namespace, key, value, ttl, local_only=local_only)
+            return value
+        return wrapper
+    return decorator
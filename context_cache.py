@@ -0,0 +1,113 @@
+import os
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+
+# --- コンテキストキャッシュの設定 (環境変数で上書き可能) ---
+CONTEXT_CACHE_TTL_MINUTES = int(os.getenv("CONTEXT_CACHE_TTL_MINUTES", "30"))
+# Geminiのキャッシュには最小トークン数があるため、短いプレフィックスはローカル追跡のみ行う (文字数 / 2 で概算)
+CONTEXT_CACHE_MIN_CHARS = int(os.getenv("CONTEXT_CACHE_MIN_CHARS", "4096"))
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "256"))
+# キャッシュの作成に失敗したプレフィックスで、再び作成を試みるまでの秒数
+CONTEXT_CACHE_RETRY_SECONDS = float(os.getenv("CONTEXT_CACHE_RETRY_SECONDS", "300"))
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+class _PrefixEntry:
+    def __init__(self):
+        self.uses = 0
+        self.cached_content = None
+        self.expires_at = 0.0
+        self.retry_after = 0.0
+        # 同じプレフィックスを並列に使う場合（一括編集など）に、リモートキャッシュを1つだけ作成するためのロック
+        self.lock = threading.Lock()
+
+
+def prefix_fingerprint(model_name: str, prefix: str) -> str:
+    """モデル名とプレフィックスからキャッシュ用のハッシュを計算します。"""
+    return hashlib.sha256(f"{model_name}\n{prefix}".encode('utf-8')).hexdigest()
+
+
+def _get_entry(key) -> _PrefixEntry:
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            entry = _PrefixEntry()
+            _entries[key] = entry
+            while len(_entries) > CONTEXT_CACHE_MAX_ENTRIES:
+                _entries.popitem(last=False)
+        else:
+            _entries.move_to_end(key)
+        entry.uses += 1
+        return entry
+
+
+def _create_remote_cache(model, prefix: str):
+    from google.generativeai import caching
+    ttl = datetime.timedelta(minutes=CONTEXT_CACHE_TTL_MINUTES)
+    if not hasattr(model, 'cache_client'):
+        return caching.CachedContent.create(model=model.model_name, contents=[prefix], ttl=ttl)
+    # CachedContent.create() はプロセス全体の既定のAPIキーを使うため、モデルのAPIキーのクライアントで作成する
+    request = caching.CachedContent._prepare_create_request(model=model.model_name, contents=[prefix], ttl=ttl)
+    return caching.CachedContent._from_obj(model.cache_client().create_cached_content(request))
+
+
+def _get_cached_content(entry: _PrefixEntry, model, prefix: str):
+    """有効なリモートキャッシュを返します。なければ作成し、作成できない場合は None を返します。
+
+    作成はエントリごとのロックの中で行うため、並列に呼ばれても作成されるのは1つだけで、他の呼び出しはそれを待って使います。
+    作成に失敗した場合は CONTEXT_CACHE_RETRY_SECONDS 秒の間だけ作成を見送ります。
+    """
+    with entry.lock:
+        now = time.time()
+        if entry.cached_content is not None and entry.expires_at > now:
+            return entry.cached_content
+        if now < entry.retry_after:
+            return None
+        try:
+            entry.cached_content = _create_remote_cache(model, prefix)
+            # 期限ぎりぎりの利用を避けるため、少し早めに失効扱いにする
+            entry.expires_at = now + CONTEXT_CACHE_TTL_MINUTES * 60 - 60
+            logging.info(f"Context cache created: {entry.cached_content.name}")
+        except Exception as e:
+            logging.warning(f"Context cache creation failed, falling back to full prompt: {e}")
+            entry.cached_content = None
+            entry.retry_after = now + CONTEXT_CACHE_RETRY_SECONDS
+        return entry.cached_content
+
+
+def generate_with_cached_prefix(model, prefix: str, suffix: str, owner: str):
+    """大きく変化しないプレフィックスをキャッシュしながら generate_content を呼び出します。
+
+    同じプレフィックスが2回目に使われた時点でGeminiのコンテキストキャッシュを作成し、以降は差分(suffix)だけを送信します。
+    キャッシュを作成できない場合はプレフィックスのハッシュだけを追跡し、先頭が一致する完全なプロンプトを送信します。
+    prefix には命令・参考情報など呼び出しをまたいで変わらない部分だけを入れ、編集対象のページ内容などは suffix に入れてください。
+    戻り値は (レスポンス, キャッシュを利用したかどうか) のタプルです。
+    """
+    key = (owner, prefix_fingerprint(model.model_name, prefix))
+    entry = _get_entry(key)
+
+    # 2回目以降の利用で、かつ十分な長さがある場合のみリモートキャッシュを作成・利用する
+    if entry.uses >= 2 and len(prefix) >= CONTEXT_CACHE_MIN_CHARS:
+        cached_content = _get_cached_content(entry, model, prefix)
+        if cached_content is not None:
+            try:
+                import google.generativeai as genai
+                cached_model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+                if hasattr(model, 'with_model'):
+                    # レート制限の予算とAPIキーは元のモデルと共有する
+                    cached_model = model.with_model(cached_model)
+                return cached_model.generate_content(suffix), True
+            except Exception as e:
+                logging.warning(f"Generation with context cache failed, falling back to full prompt: {e}")
+                with entry.lock:
+                    # 他のスレッドが作り直したキャッシュは破棄しない
+                    if entry.cached_content is cached_content:
+                        entry.cached_content = None
+
+    return model.generate_content(prefix + suffix), False
@@ -1,13 +1,69 @@
 import streamlit as st
-from ddgs import DDGS
-import trafilatura
 import traceback
-import httpx
+import threading
+import contextlib
 import io
-import pdfplumber
-import docx
+import hashlib
+import time
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from notion_utils import notion_blocks_to_markdown, markdown_to_notion_blocks
+from notion_utils import notion_blocks_to_markdown, markdown_to_notion_blocks, list_all_blocks, page_title, RateLimitedNotion
+from gemini_governor import batch_priority, current_priority, BATCH
+from context_cache import generate_with_cached_prefix
+import generation_cache
+import block_patch
+import long_form_utils
+import usage_meter
+from text_dedup import dedupe_articles
+
+# バックグラウンドジョブではスクリプトスレッド外で実行されるため、st.session_state の代わりにスレッドごとのクライアントを使う
+_run_context = threading.local()
+
+def _clients():
+    """現在のスレッドで使うAPIクライアント群（notion_client, gemini_model, gemini_lite_model）を返します。"""
+    return getattr(_run_context, 'clients', None) or st.session_state
+
+@contextlib.contextmanager
+def use_clients(clients):
+    """このスレッドの処理で、st.session_state の代わりに指定したクライアント群を使います。"""
+    previous = getattr(_run_context, 'clients', None)
+    _run_context.clients = clients
+    try:
+        # ワーカースレッドで記録される使用量も、クライアントの持ち主に帰属させる
+        with usage_meter.attribute_to(getattr(clients, 'current_user', None) or usage_meter.current_user()):
+            yield
+    finally:
+        _run_context.clients = previous
+
+class _NullCheckpoint:
+    """チェックポイントを使わない実行（画面からの直接実行）用の、何も保存しないチェックポイント。"""
+
+    def get(self, key, default=None):
+        return default
+
+    def save(self, **fields):
+        pass
+
+_NULL_CHECKPOINT = _NullCheckpoint()
+
+def _checkpoint():
+    """現在のスレッドの処理の途中経過を保存するチェックポイントを返します。"""
+    return getattr(_run_context, 'checkpoint', None) or _NULL_CHECKPOINT
+
+@contextlib.contextmanager
+def use_checkpoint(checkpoint):
+    """このスレッドの処理で、途中経過を checkpoint に保存し、保存済みの途中経過から再開します。
+
+    checkpoint は get(key, default) と save(**fields) を持つオブジェクトです。再開されたバックグラウンドジョブが、
+    ページを二重に作成したり同じ内容を二重に追記したりしないようにするために使います。
+    """
+    previous = getattr(_run_context, 'checkpoint', None)
+    _run_context.checkpoint = checkpoint
+    try:
+        yield
+    finally:
+        _run_context.checkpoint = previous
 
 def process_uploaded_files(uploaded_files):
     # (この関数に変更はありません)
@@ -17,13 +73,16 @@ def process_uploaded_files(uploaded_files):
     for uploaded_file in uploaded_files:
         full_text += f"--- 参考資料: {uploaded_file.name} ---\n\n"
         try:
+            # PDF/Wordの解析ライブラリは重いため、該当するファイルがアップロードされた時だけ読み込む
             if uploaded_file.name.lower().endswith('.pdf'):
+                import pdfplumber
                 with pdfplumber.open(uploaded_file) as pdf:
                     for page in pdf.pages:
                         text = page.extract_text()
                         if text:
                             full_text += text + "\n"
             elif uploaded_file.name.lower().endswith('.docx'):
+                import docx
                 document = docx.Document(uploaded_file)
                 for para in document.paragraphs:
                     full_text += para.text + "\n"
@@ -37,38 +96,72 @@ def process_uploaded_files(uploaded_files):
 
 def get_content_from_single_url(url: str, status_placeholder):
     # (この関数に変更はありません)
+    import trafilatura
+    from http_client import get_http_client
     status_placeholder.info(f"単一URLから本文を抽出しています: {url}")
-    HEADERS = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/115.0',
-    }
     try:
-        with httpx.Client(headers=HEADERS, follow_redirects=True, timeout=15.0) as client:
-            response = client.get(url)
-            response.raise_for_status() 
-            extracted = trafilatura.extract(response.text, include_comments=False, include_tables=True)
-            if extracted:
-                return f"--- 参考URL: {url} ---\n\n{extracted}"
-            else:
-                st.error(f"URLから本文を抽出できませんでした。コンテンツが記事形式でない可能性があります。: {url}")
-                return None
+        response = get_http_client().get(url)
+        response.raise_for_status()
+        extracted = trafilatura.extract(response.text, include_comments=False, include_tables=True)
+        if extracted:
+            return f"--- 参考URL: {url} ---\n\n{extracted}"
+        else:
+            st.error(f"URLから本文を抽出できませんでした。コンテンツが記事形式でない可能性があります。: {url}")
+            return None
     except Exception as e:
         st.error(f"URLの処理中にエラーが発生しました: {url}\n原因: {e}")
         return None
 
-# --- generate_content_from_web 関数を大幅に修正 ---
-def generate_content_from_web(user_prompt: str, search_count: int, full_text_token_limit: int, status_placeholder, results_placeholder):
-    status_placeholder.info("1/5: リクエストからキーワードを抽出しています...")
+def _extract_search_keywords(user_prompt: str) -> str:
+    """リクエスト文から検索に使うキーワードを抽出します。抽出できない場合はリクエスト文をそのまま返します。"""
     keyword_prompt = f"以下の「リクエスト文」から、Web検索に使うべき最も重要なキーワード（固有名詞など）を最大5つ、カンマ区切りで抜き出してください。\n\nリクエスト文：{user_prompt}\nキーワード："
-    keyword_response = st.session_state.gemini_lite_model.generate_content(keyword_prompt)
-    search_keywords = keyword_response.text.strip().replace("\n", "")
+    keyword_response = _clients().gemini_lite_model.generate_content(keyword_prompt)
+    return keyword_response.text.strip().replace("\n", "") or user_prompt
+
+def get_content_from_notion_index(search_keywords: str, search_count: int, full_text_token_limit: int, status_placeholder, results_placeholder):
+    """ローカルに同期したNotionワークスペースの索引から、キーワードに関連するページを参考情報として返します。
+
+    関連するページがない場合は None を返し、呼び出し元がWeb検索に切り替えられるようにします。
+    """
+    import notion_index
+    status_placeholder.info(f"Notionワークスペースの索引から「{search_keywords}」に関連するページを検索しています...")
+    try:
+        pages = notion_index.search(_clients().notion_client, search_keywords, limit=search_count)
+    except Exception as e:
+        st.warning(f"Notionワークスペースの索引を検索できませんでした: {e}")
+        return None
+    if not pages:
+        status_placeholder.info("索引に関連するページが見つからなかったため、Web検索に切り替えます...")
+        return None
+    with results_placeholder.container():
+        with st.expander(f"参考にしたNotionページ ({len(pages)}件)"):
+            for page in pages:
+                st.markdown(f"- {page['title']}")
+    # トークン上限（文字数 / 2 で概算）を超えない範囲で、関連度の高いページから順に使う
+    char_limit = full_text_token_limit * 2
+    context = ""
+    for page in pages:
+        section = f"--- 参考ページ: {page['title']} ---\n\n{page['content']}\n\n"
+        if context and len(context) + len(section) > char_limit:
+            break
+        context += section[:char_limit]
+    return context
+
+# --- generate_content_from_web 関数を大幅に修正 ---
+def generate_content_from_web(user_prompt: str, search_count: int, full_text_token_limit: int, status_placeholder, results_placeholder, search_keywords: str = None):
+    import trafilatura
+    import web_search
+    from http_client import get_http_client
     if not search_keywords:
-        search_keywords = user_prompt
+        status_placeholder.info("1/5: リクエストからキーワードを抽出しています...")
+        search_keywords = _extract_search_keywords(user_prompt)
     search_query = f"{search_keywords} -filetype:pdf"
     status_placeholder.info(f"2/5: 「{search_query}」でWeb検索を実行中...")
-    search_results = list(DDGS().text(search_query, max_results=search_count))
+    # 複数の検索バックエンドにヘッジ付きで問い合わせ、遅い・制限中のバックエンドで処理が止まらないようにする
+    search_results = web_search.search(search_query, search_count)
     if not search_results:
         st.error("Web検索で情報を取得できませんでした。")
-        return None, None
+        return None
     with results_placeholder.container():
         st.info(f"🤖 **検索クエリ (PDF除外):** `{search_query}`")
         with st.expander(f"参考にしたWebサイト ({len(search_results)}件)"):
@@ -76,27 +169,31 @@ def generate_content_from_web(user_prompt: str, search_count: int, full_text_tok
                 st.markdown(f"- [{result.get('title')}]({result.get('href')})")
     
     status_placeholder.info("3/5: Webページから記事本文を抽出しています...")
-    HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/115.0'}
     extracted_articles = []
-    with httpx.Client(headers=HEADERS, follow_redirects=True, timeout=15.0) as client:
-        for i, result in enumerate(search_results):
-            url = result.get('href')
-            if url:
-                try:
-                    response = client.get(url)
-                    response.raise_for_status()
-                    extracted = trafilatura.extract(response.text, include_comments=False, include_tables=True)
-                    if extracted:
-                        extracted_articles.append({"url": url, "text": extracted})
-                    else:
-                        st.warning(f"  - [{i+1}/{len(search_results)}] 本文抽出失敗: {url}")
-                except Exception as e:
-                    st.warning(f"  - [{i+1}/{len(search_results)}] URL処理失敗: {url}\n  - 原因: {e}")
-                    continue
+    client = get_http_client()
+    for i, result in enumerate(search_results):
+        url = result.get('href')
+        if url:
+            try:
+                response = client.get(url)
+                response.raise_for_status()
+                extracted = trafilatura.extract(response.text, include_comments=False, include_tables=True)
+                if extracted:
+                    extracted_articles.append({"url": url, "text": extracted})
+                else:
+                    st.warning(f"  - [{i+1}/{len(search_results)}] 本文抽出失敗: {url}")
+            except Exception as e:
+                st.warning(f"  - [{i+1}/{len(search_results)}] URL処理失敗: {url}\n  - 原因: {e}")
+                continue
     if not extracted_articles:
         st.error("どのWebサイトからも記事本文を抽出できませんでした。キーワードを変えて再度お試しください。")
-        return None, None
+        return None
     
+    # 転載・ミラー記事や共通の段落は、トークン予算を消費する前に取り除く
+    extracted_articles, dedup_stats = dedupe_articles(extracted_articles)
+    if dedup_stats['duplicate_articles'] or dedup_stats['duplicate_paragraphs']:
+        st.info(f"重複を除去しました: 記事 {dedup_stats['duplicate_articles']}件、段落 {dedup_stats['duplicate_paragraphs']}件（約{dedup_stats['removed_chars']}文字）")
+
     # --- ここからがハイブリッド戦略のロジック ---
     status_placeholder.info("4/5: トークン数を管理しながら参考情報を構築しています...")
     final_context = ""
@@ -120,7 +217,7 @@ def generate_content_from_web(user_prompt: str, search_count: int, full_text_tok
         status_placeholder.info("トークン上限を超えたため、残りの記事を要約しています...")
         summarize_prompt = f"以下の複数の記事群を、ユーザーのリクエストに沿うように重要なポイントを一つの文章にまとめてください。\n\nユーザーリクエスト: {user_prompt}\n\n--- 記事群 ---\n{remaining_articles_text}"
         try:
-            summary_response = st.session_state.gemini_lite_model.generate_content(summarize_prompt)
+            summary_response = _clients().gemini_lite_model.generate_content(summarize_prompt)
             final_context += f"--- 複数の参考記事の要約 ---\n{summary_response.text}\n\n"
             st.info("残りの記事の要約が完了しました。")
         except Exception as e:
@@ -162,21 +259,69 @@ def parse_gemini_output(text, fallback_prompt):
 
 # ... これ以降の run_new_page_process などの関数は変更ありません ...
 # --- run_new_page_process 関数を修正 ---
-def run_new_page_process(database_id, user_prompt, ai_persona, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder):
+def _create_database_page(database_id, title, blocks):
+    """データベースに新しいページを作成し、101件目以降のブロックは100件ずつ追記して、ページIDを返します。
+
+    チェックポイントに作成済みのページがある場合は、新しく作成せずに書き込み済みのブロックの続きから追記します。
+    """
+    checkpoint = _checkpoint()
+    page_id = checkpoint.get('page_id')
+    written = checkpoint.get('blocks_written', 0)
+    if not page_id:
+        db_info = _clients().notion_client.databases.retrieve(database_id=database_id)
+        title_prop_name = next((k for k, v in db_info['properties'].items() if v['type'] == 'title'), 'Name')
+        parent_payload = {"database_id": database_id}
+        properties_payload = {title_prop_name: {"title": [{"text": {"content": title}}]}}
+        created_page = _clients().notion_client.pages.create(parent=parent_payload, properties=properties_payload, children=blocks[:100])
+        page_id = created_page['id']
+        written = min(100, len(blocks))
+        checkpoint.save(page_id=page_id, blocks_written=written)
+    for i in range(written, len(blocks), 100):
+        chunk = blocks[i:i+100]
+        _clients().notion_client.blocks.children.append(block_id=page_id, children=chunk)
+        checkpoint.save(blocks_written=i + len(chunk))
+    return page_id
+
+def run_new_page_process(database_id, user_prompt, ai_persona, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder, regenerate=False, use_notion_index=False, long_form=False):
     try:
-        full_text_context = ""
-        if uploaded_files:
-            status_placeholder.info("アップロードされたファイルを読み込んでいます...")
-            full_text_context = process_uploaded_files(uploaded_files)
-        elif source_url:
-            full_text_context = get_content_from_single_url(source_url, status_placeholder)
+        # 同じフォームの再送信（二重クリックやNotion書き込み失敗後の再試行）では、前回の生成結果を再利用する
+        cache_key = generation_cache.make_key(
+            _clients().gemini_model.model_name, ai_persona, user_prompt, "long_form" if long_form else "new", database_id,
+            generation_cache.source_fingerprint(uploaded_files, source_url, search_count, full_text_token_limit, use_notion_index),
+        )
+        checkpoint = _checkpoint()
+        if long_form and checkpoint.get('outline'):
+            # 中断されたジョブの再開では、保存済みのアウトラインと参考情報で続きのセクションだけを生成する
+            return _run_long_form_generation(database_id, None, user_prompt, ai_persona, cache_key, status_placeholder, results_placeholder)
+        # 中断されたジョブの再開では、regenerate の指定にかかわらず途中まで書き込んだ記事と同じ内容を使う
+        cached_result = checkpoint.get('article') or (None if regenerate else generation_cache.get(cache_key))
+        if cached_result:
+            status_placeholder.info("前回の生成結果を再利用しています...")
+            title, content = cached_result
         else:
-            full_text_context = generate_content_from_web(user_prompt, search_count, full_text_token_limit, status_placeholder, results_placeholder)
-        if not full_text_context:
-            st.error("参考情報が見つからなかったため、処理を中断しました。")
-            return
-        # ... (これ以降のロジックは変更なし) ...
-        final_prompt = f'''
+            full_text_context = ""
+            if uploaded_files:
+                status_placeholder.info("アップロードされたファイルを読み込んでいます...")
+                full_text_context = process_uploaded_files(uploaded_files)
+            elif source_url:
+                full_text_context = get_content_from_single_url(source_url, status_placeholder)
+            else:
+                # 社内の既存ページで足りる場合は、Web検索の往復を省略する
+                # 索引はテンプレート的な言い回しでも一致してしまうため、リクエスト文ではなく抽出したキーワードで検索する
+                search_keywords = None
+                if use_notion_index:
+                    status_placeholder.info("リクエストからキーワードを抽出しています...")
+                    search_keywords = _extract_search_keywords(user_prompt)
+                    full_text_context = get_content_from_notion_index(search_keywords, search_count, full_text_token_limit, status_placeholder, results_placeholder)
+                if not full_text_context:
+                    full_text_context = generate_content_from_web(user_prompt, search_count, full_text_token_limit, status_placeholder, results_placeholder, search_keywords=search_keywords)
+            if not full_text_context:
+                status_placeholder.error("参考情報が見つからなかったため、処理を中断しました。")
+                return False
+            if long_form:
+                return _run_long_form_generation(database_id, full_text_context, user_prompt, ai_persona, cache_key, status_placeholder, results_placeholder)
+            # ... (これ以降のロジックは変更なし) ...
+            final_prompt = f'''
 # 命令
 {ai_persona} 与えられた「参考情報」と「リクエスト」に基づき、魅力的で分かりやすい記事を作成してください。
 出力は必ず「タイトル：～」「本文：～」の形式で、本文はNotionで表示可能なMarkdown形式で記述してください。
@@ -189,97 +334,470 @@ def run_new_page_process(database_id, user_prompt, ai_persona, uploaded_files, s
 タイトル：(ここに記事のタイトルを記述)
 本文：(ここに上記の書式ルールに従ったNotion記法のMarkdownで記事の本文を記述)
 '''
-        response = st.session_state.gemini_model.generate_content(final_prompt)
-        text = response.text
-        title, content = parse_gemini_output(text, user_prompt)
+            response = _clients().gemini_model.generate_content(final_prompt)
+            text = response.text
+            title, content = parse_gemini_output(text, user_prompt)
+            generation_cache.put(cache_key, title, content)
+        checkpoint.save(article=[title, content])
         with results_placeholder.container(border=True):
             st.markdown(f"### プレビュー: {title}")
             st.markdown(content)
             st.info("上記の内容でNotionに新しいページを作成します。")
         status_placeholder.info("Notionに新しいページを作成中...")
-        all_blocks = markdown_to_notion_blocks(content)
-        db_info = st.session_state.notion_client.databases.retrieve(database_id=database_id)
-        title_prop_name = next((k for k, v in db_info['properties'].items() if v['type'] == 'title'), 'Name')
-        parent_payload = {"database_id": database_id}
-        properties_payload = {title_prop_name: {"title": [{"text": {"content": title}}]}}
-        created_page = st.session_state.notion_client.pages.create(parent=parent_payload, properties=properties_payload, children=all_blocks[:100])
-        if len(all_blocks) > 100:
-            page_id = created_page['id']
-            for i in range(100, len(all_blocks), 100):
-                chunk = all_blocks[i:i+100]
-                st.session_state.notion_client.blocks.children.append(block_id=page_id, children=chunk)
+        _create_database_page(database_id, title, markdown_to_notion_blocks(content))
         st.balloons()
         status_placeholder.success(f"✅ 新規ページ「{title}」の作成が完了しました！")
+        return True
     except Exception as e:
-        st.error(f"❌ 新規ページ作成中にエラーが発生しました: {e}")
+        status_placeholder.error(f"❌ 新規ページ作成中にエラーが発生しました: {e}")
         st.code(traceback.format_exc())
+        return False
 
 
-# --- run_edit_page_process 関数を修正 ---
-def run_edit_page_process(page_id, user_prompt, ai_persona, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder):
-    try:
-        status_placeholder.info("1/4: Notionから既存のコンテンツを読み込んでいます...")
-        existing_blocks_response = st.session_state.notion_client.blocks.children.list(block_id=page_id)
-        existing_markdown = notion_blocks_to_markdown(existing_blocks_response.get('results', []), st.session_state.notion_client)
-        with results_placeholder.container(border=True):
-            with st.expander("現在のページ内容（Markdown）"):
-                st.markdown(existing_markdown or "（このページは空です）")
-        
-        full_text_context = ""
-        if uploaded_files:
-            status_placeholder.info("2/4: アップロードされたファイルを読み込んでいます...")
-            full_text_context = process_uploaded_files(uploaded_files)
-        elif source_url:
-            status_placeholder.info("2/4: 単一URLから情報を抽出しています...")
-            full_text_context = get_content_from_single_url(source_url, status_placeholder)
-        else:
-            status_placeholder.info("2/4: Webからの情報収集を開始します...")
-            full_text_context = generate_content_from_web(user_prompt, search_count, full_text_token_limit, status_placeholder, results_placeholder)
-        
-        if not full_text_context:
-            st.error("参考情報が見つからなかったため、処理を中断しました。")
-            return
-        
-        status_placeholder.info("3/4: AIによる追記コンテンツの生成を開始します...")
-        final_prompt = f'''
+def _generate_outline(full_text_context, user_prompt, ai_persona):
+    """記事のアウトラインを生成し、(タイトル, 導入文, セクションのリスト) を返します。"""
+    outline_prompt = f'''
+# 命令
+{ai_persona} 与えられた「参考情報」と「リクエスト」に基づき、記事の**アウトラインのみ**を作成してください。
+セクションは{long_form_utils.LONG_FORM_MAX_SECTIONS}個以内とし、各セクションは互いに内容が重複しないようにしてください。
+# 参考情報
+{full_text_context}
+# リクエスト
+{user_prompt}
+# 出力形式 (***必ず厳守***)
+タイトル：(ここに記事のタイトルを記述)
+導入：(ここに記事の導入文を2〜3文で記述)
+## (セクション1の見出し)
+- (このセクションで扱う要点)
+- (このセクションで扱う要点)
+## (セクション2の見出し)
+- (このセクションで扱う要点)
+'''
+    response = _clients().gemini_model.generate_content(outline_prompt)
+    return long_form_utils.parse_outline(response.text, user_prompt)
+
+def _generate_section(title, outline_markdown, section, section_context, user_prompt, ai_persona):
+    """ワーカースレッドで1セクション分の本文を生成して返します（Streamlitの描画は行わない）。"""
+    points = "\n".join(f"- {point}" for point in section['points'])
+    section_prompt = f'''
 # 命令
-{ai_persona} 以下の「既存の記事」と「参考情報」を踏まえ、ユーザーからの「追記リクエスト」に的確に答える形で、**追記すべき新しい文章のみ**を生成してください。
+{ai_persona} 記事「{title}」のうち、「担当セクション」の本文だけを執筆してください。
+他のセクションは別の担当者が並行して執筆するため、「記事全体のアウトライン」にある他のセクションの内容は書かないでください。
+見出し、箇条書き、**太字**などを活用し、Notionで表示可能なMarkdown形式で記述してください。セクションの見出し自体は出力しないでください。
+# 記事全体のアウトライン
+{outline_markdown}
+# 担当セクション
+## {section['heading']}
+{points}
+# 参考情報
+{section_context}
+# リクエスト
+{user_prompt}
+'''
+    response = _clients().gemini_model.generate_content(section_prompt)
+    return long_form_utils.strip_repeated_heading(response.text, section['heading'])
+
+def _run_long_form_generation(database_id, full_text_context, user_prompt, ai_persona, cache_key, status_placeholder, results_placeholder):
+    """アウトラインを生成した後、セクションごとに関連する参考情報だけを渡して並列に生成します。
+
+    ページはアウトラインの生成後すぐに作成し、セクションは完成した順ではなく記事の順序どおりに、
+    前のセクションがそろった時点で順次Notionへ追記します。
+    """
+    checkpoint = _checkpoint()
+    outline = checkpoint.get('outline')
+    if outline:
+        status_placeholder.info("長文モード: 中断前のアウトラインから再開しています...")
+        title, intro, sections = outline['title'], outline['intro'], outline['sections']
+        full_text_context = checkpoint.get('context', "")
+    else:
+        status_placeholder.info("長文モード: 記事のアウトラインを生成しています...")
+        title, intro, sections = _generate_outline(full_text_context, user_prompt, ai_persona)
+        if not sections:
+            status_placeholder.error("アウトラインを生成できなかったため、処理を中断しました。")
+            return False
+        checkpoint.save(outline={'title': title, 'intro': intro, 'sections': sections}, context=full_text_context)
+    outline_markdown = "\n".join(f"## {section['heading']}" for section in sections)
+    chunks = long_form_utils.split_chunks(full_text_context)
+
+    page_id = _create_database_page(database_id, title, markdown_to_notion_blocks(intro) if intro else [])
+    written_sections = checkpoint.get('written_sections', [])
+    preview = results_placeholder.container(border=True)
+    with preview:
+        st.markdown(f"### プレビュー: {title}")
+        st.markdown(intro)
+        for section_markdown in written_sections:
+            st.markdown(section_markdown)
+
+    session = _clients()
+    worker_clients = SimpleNamespace(
+        notion_client=session.notion_client,
+        gemini_model=session.gemini_model,
+        gemini_lite_model=session.gemini_lite_model,
+        current_user=getattr(session, 'current_user', ''),
+    )
+    # バックグラウンドジョブから呼ばれた場合は、ワーカースレッドでもバッチ扱いの優先度を引き継ぐ
+    priority = batch_priority if current_priority() == BATCH else contextlib.nullcontext
+
+    def generate(section):
+        query = section['heading'] + "\n" + "\n".join(section['points'])
+        with use_clients(worker_clients), priority():
+            return _generate_section(title, outline_markdown, section, long_form_utils.select_chunks(chunks, query), user_prompt, ai_persona)
+
+    written = len(written_sections)
+    # 生成済みだが、前のセクションがそろっていないためまだ書き込んでいないセクション（チェックポイントのキーは文字列になる）
+    finished = {int(index): body for index, body in checkpoint.get('generated_sections', {}).items() if int(index) >= written}
+    failed = {}
+    parts = ([intro] if intro else []) + written_sections
+    started = time.perf_counter()
+
+    def write_ready_sections():
+        # 記事の順序を保つため、先頭から連続して完成しているセクションだけを書き込む。
+        # 生成に失敗したセクションがあればそこで止め、以降のセクションは再開時に失敗したセクションの後ろへ書き込む
+        nonlocal written
+        while written in finished:
+            section_markdown = f"## {sections[written]['heading']}\n{finished.pop(written)}"
+            _append_markdown(page_id, section_markdown, progress_key='section_blocks_written')
+            parts.append(section_markdown)
+            written_sections.append(section_markdown)
+            written += 1
+            checkpoint.save(written_sections=written_sections, section_blocks_written=0,
+                            generated_sections={str(index): body for index, body in finished.items()})
+            with preview:
+                st.markdown(section_markdown)
+
+    write_ready_sections()
+    pending = [index for index in range(written, len(sections)) if index not in finished]
+    status_placeholder.info(f"長文モード: {len(sections)}セクションを並列に生成しています... ({written}/{len(sections)})")
+    with ThreadPoolExecutor(max_workers=long_form_utils.LONG_FORM_CONCURRENCY) as executor:
+        futures = {executor.submit(generate, sections[index]): index for index in pending}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                finished[index] = future.result()
+            except Exception as e:
+                failed[index] = e
+                continue
+            checkpoint.save(generated_sections={str(i): body for i, body in finished.items()})
+            write_ready_sections()
+            status_placeholder.info(f"長文モード: {len(sections)}セクションを並列に生成しています... ({written}/{len(sections)}を書き込み済み)")
+    elapsed = time.perf_counter() - started
+
+    if failed:
+        details = [f"{sections[index]['heading']}（{failed[index]}）" for index in sorted(failed)]
+        status_placeholder.warning(
+            f"⚠️ ページ「{title}」を作成しましたが、{len(failed)}セクションの生成に失敗したため、"
+            f"「{sections[min(failed)]['heading']}」以降は書き込んでいません: {', '.join(details)}"
+            "（バックグラウンドジョブの場合は、再登録すると失敗したセクションから続きを生成します）"
+        )
+        return False
+    generation_cache.put(cache_key, title, "\n\n".join(parts))
+    st.balloons()
+    status_placeholder.success(f"✅ 新規ページ「{title}」の作成が完了しました！（{len(sections)}セクション / {elapsed:.1f}秒）")
+    return True
+
+
+def _collect_reference_context(user_prompt, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder, step=""):
+    """ファイル > 単一URL > Web検索 の優先順位で参考情報を集めます。"""
+    if uploaded_files:
+        status_placeholder.info(f"{step}アップロードされたファイルを読み込んでいます...")
+        return process_uploaded_files(uploaded_files)
+    if source_url:
+        status_placeholder.info(f"{step}単一URLから情報を抽出しています...")
+        return get_content_from_single_url(source_url, status_placeholder)
+    status_placeholder.info(f"{step}Webからの情報収集を開始します...")
+    return generate_content_from_web(user_prompt, search_count, full_text_token_limit, status_placeholder, results_placeholder)
+
+def _read_page_markdown(page_id):
+    """ページの既存コンテンツをMarkdownとして読み込みます。"""
+    blocks = list_all_blocks(_clients().notion_client, page_id)
+    return notion_blocks_to_markdown(blocks, _clients().notion_client)
+
+def _generate_appendix(existing_markdown, full_text_context, user_prompt, ai_persona):
+    """既存の記事に追記する文章を生成し、(タイトル, 本文, コンテキストキャッシュを使ったか) を返します。"""
+    # 既存の記事は追記のたびに変わるため、変化しない部分（命令・ペルソナ・参考情報）だけをプロンプトの先頭にまとめてキャッシュする
+    prompt_prefix = f'''
+# 命令
+{ai_persona} 後に示す「既存の記事」と以下の「参考情報」を踏まえ、ユーザーからの「追記リクエスト」に的確に答える形で、**追記すべき新しい文章のみ**を生成してください。
 既存の記事の内容を繰り返す必要はありません。
-# 既存の記事
-{existing_markdown}
 # 参考情報
 {full_text_context}
+'''
+    prompt_suffix = f'''# 既存の記事
+{existing_markdown}
 # 追記リクエスト
 {user_prompt}
 # 出力形式 (***必ず厳守***)
 タイトル：(ここに既存の記事タイトル、または新しいタイトルを記述)
 本文：(ここに**追記すべき新しい文章**をMarkdown形式で記述)
 '''
-        # ... (これ以降のロジックは変更なし) ...
-        response = st.session_state.gemini_model.generate_content(final_prompt)
-        text = response.text
-        title, content = parse_gemini_output(text, user_prompt)
+    response, used_context_cache = generate_with_cached_prefix(
+        _clients().gemini_model, prompt_prefix, prompt_suffix, owner=getattr(_clients(), 'current_user', '')
+    )
+    title, content = parse_gemini_output(response.text, user_prompt)
+    return title, content, used_context_cache
+
+def _update_page_title(page_id, title):
+    """データベース内のページであれば、タイトルプロパティを更新します。"""
+    page_info = _clients().notion_client.pages.retrieve(page_id=page_id)
+    db_id = page_info.get('parent', {}).get('database_id')
+    if db_id:
+        db_info = _clients().notion_client.databases.retrieve(database_id=db_id)
+        title_prop_name = next((k for k, v in db_info['properties'].items() if v['type'] == 'title'), None)
+        if title_prop_name:
+            _clients().notion_client.pages.update(page_id=page_id, properties={title_prop_name: {"title": [{"text": {"content": title}}]}})
+
+def _append_markdown(page_id, content, progress_key=None):
+    """Markdownをブロックに変換し、ページの末尾に100件ずつ追記します。
+
+    progress_key を指定した場合は追記済みのブロック数をチェックポイントのその項目に保存し、保存済みの位置の続きから追記します。
+    """
+    checkpoint = _checkpoint()
+    new_blocks = markdown_to_notion_blocks(content)
+    start = checkpoint.get(progress_key, 0) if progress_key else 0
+    for i in range(start, len(new_blocks), 100):
+        chunk = new_blocks[i:i+100]
+        _clients().notion_client.blocks.children.append(block_id=page_id, children=chunk)
+        if progress_key:
+            checkpoint.save(**{progress_key: i + len(chunk)})
+
+
+# --- run_edit_page_process 関数を修正 ---
+def run_edit_page_process(page_id, user_prompt, ai_persona, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder, regenerate=False):
+    try:
+        status_placeholder.info("1/4: Notionから既存のコンテンツを読み込んでいます...")
+        existing_markdown = _read_page_markdown(page_id)
+        with results_placeholder.container(border=True):
+            with st.expander("現在のページ内容（Markdown）"):
+                st.markdown(existing_markdown or "（このページは空です）")
+        
+        cache_key = generation_cache.make_key(
+            _clients().gemini_model.model_name, ai_persona, user_prompt, "edit", page_id,
+            hashlib.sha256(existing_markdown.encode('utf-8')).hexdigest(),
+            generation_cache.source_fingerprint(uploaded_files, source_url, search_count, full_text_token_limit),
+        )
+        checkpoint = _checkpoint()
+        # 中断されたジョブの再開では、ページが途中まで追記されていても、最初に生成した追記内容の続きを書き込む
+        cached_result = checkpoint.get('article') or (None if regenerate else generation_cache.get(cache_key))
+        if cached_result:
+            status_placeholder.info("2/4: 前回の生成結果を再利用しています...")
+            title, content = cached_result
+        else:
+            full_text_context = _collect_reference_context(user_prompt, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder, step="2/4: ")
+            if not full_text_context:
+                status_placeholder.error("参考情報が見つからなかったため、処理を中断しました。")
+                return False
+        
+            status_placeholder.info("3/4: AIによる追記コンテンツの生成を開始します...")
+            title, content, used_context_cache = _generate_appendix(existing_markdown, full_text_context, user_prompt, ai_persona)
+            if used_context_cache:
+                st.caption("⚡ キャッシュ済みの既存記事・参考情報を再利用して生成しました。")
+            generation_cache.put(cache_key, title, content)
+        checkpoint.save(article=[title, content])
         with results_placeholder.container(border=True):
             st.markdown(f"### プレビュー（追記部分）: {title}")
             st.markdown(content)
             st.info("上記の内容をNotionページの末尾に追記します。")
         status_placeholder.info("4/4: Notionページにコンテンツを追記中...")
         try:
-            page_info = st.session_state.notion_client.pages.retrieve(page_id=page_id)
-            db_id = page_info.get('parent', {}).get('database_id')
-            if db_id:
-                db_info = st.session_state.notion_client.databases.retrieve(database_id=db_id)
-                title_prop_name = next((k for k, v in db_info['properties'].items() if v['type'] == 'title'), None)
-                if title_prop_name:
-                    st.session_state.notion_client.pages.update(page_id=page_id, properties={title_prop_name: {"title": [{"text": {"content": title}}]}})
+            _update_page_title(page_id, title)
         except Exception as e:
             st.warning(f"ページのタイトル更新に失敗しました: {e}")
-        new_blocks = markdown_to_notion_blocks(content)
-        if new_blocks:
-            for i in range(0, len(new_blocks), 100):
-                st.session_state.notion_client.blocks.children.append(block_id=page_id, children=new_blocks[i:i+100])
+        _append_markdown(page_id, content, progress_key='blocks_appended')
         st.balloons()
         status_placeholder.success(f"✅ ページ「{title}」への追記が完了しました！")
+        return True
     except Exception as e:
-        st.error(f"❌ ページ追記中にエラーが発生しました: {e}")
-        st.code(traceback.format_exc())
\ No newline at end of file
+        status_placeholder.error(f"❌ ページ追記中にエラーが発生しました: {e}")
+        st.code(traceback.format_exc())
+        return False
+
+
+def _generate_patch(numbered_markdown, full_text_context, user_prompt, ai_persona):
+    """既存の記事に対する差分を生成し、(タイトル, 差分, コンテキストキャッシュを使ったか) を返します。"""
+    prompt_prefix = f'''
+# 命令
+{ai_persona} 後に示す「既存の記事」と以下の「参考情報」を踏まえ、ユーザーからの「修正リクエスト」に沿って記事を修正してください。
+既存の記事は [番号] ごとのブロックに分かれています。記事全体を書き直すのではなく、**変更が必要なブロックだけ**を次の形式の差分で出力してください。
+@@ replace 3-4   … ブロック3〜4を、続く行のMarkdownで置き換える（1つだけの場合は「@@ replace 3」）
+@@ insert_after 7   … ブロック7の後ろに、続く行のMarkdownを挿入する（記事の先頭に挿入する場合は 0）
+@@ delete 9   … ブロック9を削除する（続く行は不要）
+「編集できないブロック」は変更・削除しないでください。変更の必要がない場合は差分を空にしてください。
+# 参考情報
+{full_text_context}
+'''
+    prompt_suffix = f'''# 既存の記事
+{numbered_markdown}
+# 修正リクエスト
+{user_prompt}
+# 出力形式 (***必ず厳守***)
+タイトル：(ここに既存の記事タイトル、または新しいタイトルを記述)
+本文：(ここに上記の形式の**差分のみ**を記述)
+'''
+    response, used_context_cache = generate_with_cached_prefix(
+        _clients().gemini_model, prompt_prefix, prompt_suffix, owner=getattr(_clients(), 'current_user', '')
+    )
+    title, content = parse_gemini_output(response.text, user_prompt)
+    return title, content, used_context_cache
+
+def run_patch_page_process(page_id, user_prompt, ai_persona, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder, regenerate=False):
+    """既存のブロックを残したまま、変更が必要なブロックだけを更新・挿入・削除してページを修正します。"""
+    try:
+        checkpoint = _checkpoint()
+        plan = checkpoint.get('patch_plan')
+        if plan:
+            # 中断されたジョブの再開では、途中まで反映したページを読み直して差分を作り直さず、保存済みの操作の続きを反映する
+            status_placeholder.info("1/4: 中断前に作成した修正内容から再開しています...")
+            return _execute_patch_plan(page_id, plan, checkpoint, status_placeholder, results_placeholder)
+        status_placeholder.info("1/4: Notionから既存のコンテンツを読み込んでいます...")
+        blocks = list_all_blocks(_clients().notion_client, page_id)
+        items = block_patch.snapshot_page(blocks, _clients().notion_client)
+        numbered_markdown = block_patch.render_numbered(items)
+        with results_placeholder.container(border=True):
+            with st.expander("現在のページ内容（ブロック番号付き）"):
+                st.text(numbered_markdown or "（このページは空です）")
+
+        cache_key = generation_cache.make_key(
+            _clients().gemini_model.model_name, ai_persona, user_prompt, "patch", page_id,
+            hashlib.sha256(numbered_markdown.encode('utf-8')).hexdigest(),
+            generation_cache.source_fingerprint(uploaded_files, source_url, search_count, full_text_token_limit),
+        )
+        cached_result = None if regenerate else generation_cache.get(cache_key)
+        if cached_result:
+            status_placeholder.info("2/4: 前回の生成結果を再利用しています...")
+            title, patch_text = cached_result
+        else:
+            full_text_context = _collect_reference_context(user_prompt, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder, step="2/4: ")
+            if not full_text_context:
+                status_placeholder.error("参考情報が見つからなかったため、処理を中断しました。")
+                return False
+
+            status_placeholder.info("3/4: AIによる修正差分の生成を開始します...")
+            title, patch_text, used_context_cache = _generate_patch(numbered_markdown, full_text_context, user_prompt, ai_persona)
+            if used_context_cache:
+                st.caption("⚡ キャッシュ済みの既存記事・参考情報を再利用して生成しました。")
+            generation_cache.put(cache_key, title, patch_text)
+
+        patch = block_patch.parse_patch(patch_text)
+        sequence, ignored = block_patch.apply_patch(items, patch)
+        operations = block_patch.plan_operations(items, sequence)
+        plan = {'title': title, 'patch_text': patch_text, 'ignored': ignored, 'operations': operations, 'cache_key': cache_key}
+        checkpoint.save(patch_plan=plan)
+        return _execute_patch_plan(page_id, plan, checkpoint, status_placeholder, results_placeholder)
+    except Exception as e:
+        status_placeholder.error(f"❌ ページ修正中にエラーが発生しました: {e}")
+        st.code(traceback.format_exc())
+        return False
+
+def _execute_patch_plan(page_id, plan, checkpoint, status_placeholder, results_placeholder):
+    """作成したブロック操作をNotionページに反映します。反映済みの位置はチェックポイントに保存し、その続きから反映します。"""
+    title, operations = plan['title'], plan['operations']
+    counts = {kind: sum(1 for op in operations if op[0] == kind) for kind in ('update', 'delete')}
+    counts['insert'] = sum(len(op[1]) for op in operations if op[0] == 'insert')
+    with results_placeholder.container(border=True):
+        st.markdown(f"### プレビュー（修正差分）: {title}")
+        st.code(plan['patch_text'] or "（変更なし）", language="diff")
+        for message in plan['ignored']:
+            st.warning(f"差分の一部を無視しました: {message}")
+        st.info(f"更新 {counts['update']} 件・挿入 {counts['insert']} 件・削除 {counts['delete']} 件のブロック操作をNotionページに反映します。")
+
+    status_placeholder.info("4/4: Notionページに修正を反映中...")
+    try:
+        _update_page_title(page_id, title)
+    except Exception as e:
+        st.warning(f"ページのタイトル更新に失敗しました: {e}")
+    stats = block_patch.execute_operations(
+        _clients().notion_client, page_id, operations,
+        resume=checkpoint.get('patch_progress'), on_progress=lambda progress: checkpoint.save(patch_progress=progress),
+    )
+    if stats['moved_from_top']:
+        st.warning("Notion APIの制約により、ページ先頭への挿入は最初に残るブロックの直後に行いました。")
+    # ページが書き換わったため、同じリクエストで古いページに対する差分を再利用しないようにする
+    generation_cache.invalidate(plan['cache_key'])
+    st.balloons()
+    status_placeholder.success(f"✅ ページ「{title}」の修正が完了しました！（更新 {stats['update']}・挿入 {stats['insert']}・削除 {stats['delete']}）")
+    return True
+
+
+def _query_pages_for_bulk_edit(database_id, title_filter, max_pages):
+    """一括編集の対象ページを、タイトルの部分一致で絞り込んで最大 max_pages 件取得します。"""
+    notion = _clients().notion_client
+    kwargs = {'database_id': database_id, 'page_size': min(100, max_pages)}
+    if title_filter:
+        db_info = notion.databases.retrieve(database_id=database_id)
+        title_prop_name = next((k for k, v in db_info['properties'].items() if v['type'] == 'title'), 'Name')
+        kwargs['filter'] = {'property': title_prop_name, 'title': {'contains': title_filter}}
+    pages = []
+    while len(pages) < max_pages:
+        response = notion.databases.query(**kwargs)
+        pages.extend({'id': page['id'], 'title': page_title(page)} for page in response.get('results', []))
+        if not response.get('has_more'):
+            break
+        kwargs['start_cursor'] = response.get('next_cursor')
+    return pages[:max_pages]
+
+def _bulk_edit_single_page(page, full_text_context, user_prompt, ai_persona):
+    """ワーカースレッドで1ページ分の読み込み・生成・追記を行い、結果の辞書を返します（Streamlitの描画は行わない）。"""
+    started = time.perf_counter()
+    try:
+        existing_markdown = _read_page_markdown(page['id'])
+        _, content, _ = _generate_appendix(existing_markdown, full_text_context, user_prompt, ai_persona)
+        _append_markdown(page['id'], content)
+        result = "✅ 追記しました"
+    except Exception as e:
+        result = f"❌ {e}"
+    return {'ページ': page['title'], '結果': result, '所要時間(秒)': round(time.perf_counter() - started, 1)}
+
+def run_bulk_edit_process(database_id, title_filter, max_pages, concurrency, user_prompt, ai_persona, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder):
+    """データベース内の複数ページに、同じ指示による追記を並列で実行します。
+
+    参考情報は最初に1回だけ集めて全ページで共有します。Notionへの呼び出しは RateLimitedNotion で、
+    Geminiへの呼び出しは GovernedModel の予算で流量が制限されます。ページのタイトルは変更しません。
+    """
+    try:
+        status_placeholder.info("1/3: 対象ページを検索しています...")
+        pages = _query_pages_for_bulk_edit(database_id, title_filter, max_pages)
+        if not pages:
+            status_placeholder.error("条件に一致するページが見つかりませんでした。")
+            return False
+
+        full_text_context = _collect_reference_context(user_prompt, uploaded_files, source_url, search_count, full_text_token_limit, status_placeholder, results_placeholder, step="2/3: ")
+        if not full_text_context:
+            status_placeholder.error("参考情報が見つからなかったため、処理を中断しました。")
+            return False
+
+        session = _clients()
+        worker_clients = SimpleNamespace(
+            notion_client=RateLimitedNotion(session.notion_client),
+            gemini_model=session.gemini_model,
+            gemini_lite_model=session.gemini_lite_model,
+            current_user=getattr(session, 'current_user', ''),
+        )
+
+        def edit_page(page):
+            with use_clients(worker_clients), batch_priority():
+                return _bulk_edit_single_page(page, full_text_context, user_prompt, ai_persona)
+
+        results = []
+        started = time.perf_counter()
+        status_placeholder.info(f"3/3: {len(pages)}ページに追記しています... (0/{len(pages)})")
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(edit_page, page) for page in pages]
+            for future in as_completed(futures):
+                results.append(future.result())
+                status_placeholder.info(f"3/3: {len(pages)}ページに追記しています... ({len(results)}/{len(pages)})")
+        elapsed = time.perf_counter() - started
+
+        succeeded = sum(1 for r in results if r['結果'].startswith("✅"))
+        with results_placeholder.container(border=True):
+            st.markdown(f"### 一括編集の結果: {succeeded}/{len(pages)}ページ成功")
+            st.caption(f"所要時間 {elapsed:.1f}秒 / スループット {len(pages) / elapsed * 60:.1f}ページ/分")
+            st.dataframe(results, use_container_width=True)
+        if succeeded == len(pages):
+            status_placeholder.success(f"✅ {len(pages)}ページへの追記が完了しました！")
+        else:
+            status_placeholder.warning(f"⚠️ {len(pages) - succeeded}ページで追記に失敗しました。結果の一覧を確認してください。")
+        return succeeded > 0
+    except Exception as e:
+        status_placeholder.error(f"❌ 一括編集中にエラーが発生しました: {e}")
+        st.code(traceback.format_exc())
+        return False
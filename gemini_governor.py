@@ -0,0 +1,234 @@
+import os
+import time
+import random
+import hashlib
+import logging
+import threading
+import contextlib
+
+import usage_meter
+
+# --- Gemini呼び出しの予算設定 (環境変数で上書き可能。APIキー×モデルごとに適用) ---
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+# APIキーやモデルにかかわらず、プロセス全体で同時に行うGemini呼び出しの上限（多数のユーザーが同時に使う場合の接続・スレッド数を抑える）
+GEMINI_GLOBAL_MAX_CONCURRENCY = int(os.getenv("GEMINI_GLOBAL_MAX_CONCURRENCY", "16"))
+# バッチ処理は予算のこの割合を対話的な処理のために残しておく
+GEMINI_BATCH_RESERVE = float(os.getenv("GEMINI_BATCH_RESERVE", "0.25"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30.0"))
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+_global_slots = threading.BoundedSemaphore(GEMINI_GLOBAL_MAX_CONCURRENCY)
+_service_clients = {}
+_priority = threading.local()
+
+
+@contextlib.contextmanager
+def batch_priority():
+    """このスレッドで行うGemini呼び出しをバッチ（低優先度）として扱います。"""
+    previous = getattr(_priority, 'value', INTERACTIVE)
+    _priority.value = BATCH
+    try:
+        yield
+    finally:
+        _priority.value = previous
+
+
+def current_priority() -> str:
+    return getattr(_priority, 'value', INTERACTIVE)
+
+
+def estimate_tokens(contents) -> int:
+    """送信内容のトークン数を概算します（文字数 / 2）。"""
+    return int(len(str(contents)) / 2)
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    # メッセージ中の "429" では判定しない（プロンプトやURLに含まれる数字で誤判定するため）
+    name = type(error).__name__
+    return name in ('ResourceExhausted', 'TooManyRequests') or 429 in (getattr(error, 'code', None), getattr(error, 'status_code', None))
+
+
+def _is_retryable(error: Exception) -> bool:
+    name = type(error).__name__
+    return _is_rate_limited(error) or name in ('ServiceUnavailable', 'InternalServerError', 'DeadlineExceeded') or getattr(error, 'code', None) in (500, 503)
+
+
+def _is_quota_exhausted(error: Exception) -> bool:
+    # 日次クォータは待っても回復しないため、リトライせずに代替モデルへ切り替える
+    message = str(error)
+    return _is_rate_limited(error) and ('PerDay' in message or 'per day' in message.lower())
+
+
+class _KeyBudget:
+    """APIキー×モデルごとのリクエスト数・トークン数・同時実行数の予算（トークンバケット）。"""
+
+    def __init__(self, rpm: float, tpm: float, max_concurrency: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self._requests = rpm
+        self._tokens = tpm
+        self._active = 0
+        self._waiting_interactive = 0
+        self._updated_at = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens: int, priority: str):
+        reserve = GEMINI_BATCH_RESERVE if priority == BATCH else 0.0
+        need_requests = min(self.rpm, 1 + reserve * self.rpm)
+        need_tokens = min(self.tpm, tokens + reserve * self.tpm)
+        with self._cond:
+            if priority == INTERACTIVE:
+                self._waiting_interactive += 1
+            try:
+                while True:
+                    self._refill()
+                    if (self._active < self.max_concurrency
+                            and (priority == INTERACTIVE or self._waiting_interactive == 0)
+                            and self._requests >= need_requests
+                            and self._tokens >= need_tokens):
+                        self._requests -= 1
+                        self._tokens -= min(tokens, self.tpm)
+                        self._active += 1
+                        return
+                    deficit = max(
+                        (need_requests - self._requests) * 60 / self.rpm,
+                        (need_tokens - self._tokens) * 60 / self.tpm,
+                    )
+                    self._cond.wait(timeout=min(1.0, max(0.05, deficit)))
+            finally:
+                if priority == INTERACTIVE:
+                    self._waiting_interactive -= 1
+
+    def release(self, estimated_tokens: int, actual_tokens=None):
+        with self._cond:
+            if actual_tokens is not None:
+                self._tokens -= actual_tokens - min(estimated_tokens, self.tpm)
+            self._active -= 1
+            self._cond.notify_all()
+
+    def penalize(self):
+        """レート制限を受けた場合、同じ予算を使う他の呼び出しも待機させます。"""
+        with self._cond:
+            self._refill()
+            self._requests = 0
+
+
+def _get_budget(api_key: str, model_name: str) -> _KeyBudget:
+    key = (hashlib.sha256(api_key.encode('utf-8')).hexdigest(), model_name)
+    with _budgets_lock:
+        budget = _budgets.get(key)
+        if budget is None:
+            budget = _KeyBudget(GEMINI_RPM, GEMINI_TPM, GEMINI_MAX_CONCURRENCY)
+            _budgets[key] = budget
+        return budget
+
+
+def key_bound_client(service: str, api_key: str):
+    """APIキーに結び付いたGeminiのサービスクライアント（service は "generative" や "cache"）を返します。
+
+    genai.configure() はプロセス全体の既定のAPIキーを切り替えるため、複数のユーザーが同じプロセスを使う場合は
+    呼び出さず、APIキーごとに作成したクライアントをモデルに持たせます。クライアントはAPIキーごとに再利用します。
+    """
+    key = (service, hashlib.sha256(api_key.encode('utf-8')).hexdigest())
+    with _budgets_lock:
+        client = _service_clients.get(key)
+        if client is None:
+            import google.ai.generativelanguage as glm
+            client_class = getattr(glm, service.title() + "ServiceClient")
+            client = client_class(client_options={'api_key': api_key})
+            _service_clients[key] = client
+        return client
+
+
+def bind_api_key(model, api_key: str):
+    """genai.GenerativeModel が、既定のクライアントではなく api_key のクライアントで呼び出されるようにします。"""
+    model._client = key_bound_client("generative", api_key)
+    return model
+
+
+def create_model(model_name: str, api_key: str, fallback=None) -> "GovernedModel":
+    """api_key のクライアントを持つ genai.GenerativeModel を作成し、GovernedModel でラップして返します。"""
+    import google.generativeai as genai
+    return GovernedModel(bind_api_key(genai.GenerativeModel(model_name), api_key), api_key, fallback=fallback)
+
+
+class GovernedModel:
+    """genai.GenerativeModel をラップし、予算管理・リトライ・代替モデルへの切り替えを行います。
+
+    generate_content 以外の属性（model_name など）は元のモデルにそのまま委譲します。
+    """
+
+    def __init__(self, model, api_key: str, fallback=None):
+        self._model = model
+        self._api_key = api_key
+        self._budget = _get_budget(api_key, model.model_name)
+        self._fallback = fallback
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+    def with_model(self, model):
+        """同じAPIキーの予算とクライアントを共有する、別のモデル（キャッシュ付きモデルなど）のラッパーを返します。"""
+        governed = GovernedModel.__new__(GovernedModel)
+        governed._model = bind_api_key(model, self._api_key)
+        governed._api_key = self._api_key
+        governed._budget = self._budget
+        governed._fallback = None
+        return governed
+
+    def cache_client(self):
+        """このモデルのAPIキーで、コンテキストキャッシュを作成するクライアントを返します。"""
+        return key_bound_client("cache", self._api_key)
+
+    def generate_content(self, contents, **kwargs):
+        priority = current_priority()
+        estimated = estimate_tokens(contents)
+        last_error = None
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            self._budget.acquire(estimated, priority)
+            # APIキーごとの予算を確保してからプロセス全体の枠を取る（他のキーの予算待ちで全体の枠を塞がないようにする）
+            _global_slots.acquire()
+            actual = None
+            try:
+                response = self._model.generate_content(contents, **kwargs)
+                usage = getattr(response, 'usage_metadata', None)
+                actual = getattr(usage, 'total_token_count', None) if usage else None
+                usage_meter.record(gemini_requests=1, gemini_tokens=actual or estimated)
+                return response
+            except Exception as e:
+                last_error = e
+                if not _is_retryable(e) or _is_quota_exhausted(e):
+                    break
+                if _is_rate_limited(e):
+                    self._budget.penalize()
+            finally:
+                _global_slots.release()
+                self._budget.release(estimated, actual)
+            if attempt == GEMINI_MAX_RETRIES:
+                break
+            # ジッター付き指数バックオフ（待機中は同時実行枠を解放しておく）
+            delay = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * (2 ** attempt))
+            delay = random.uniform(delay / 2, delay)
+            logging.warning(f"Gemini call failed ({type(last_error).__name__}), retrying in {delay:.1f}s: {last_error}")
+            time.sleep(delay)
+
+        if self._fallback is not None and _is_rate_limited(last_error):
+            logging.warning(f"Gemini quota exhausted for {self._model.model_name}, falling back to {self._fallback.model_name}.")
+            return self._fallback.generate_content(contents, **kwargs)
+        raise last_error
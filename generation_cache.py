@@ -0,0 +1,65 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# --- 生成結果キャッシュの設定 (環境変数で上書き可能) ---
+GENERATION_CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", "128"))
+GENERATION_CACHE_TTL = float(os.getenv("GENERATION_CACHE_TTL", "3600"))
+
+_results = OrderedDict()
+_lock = threading.Lock()
+
+
+def source_fingerprint(uploaded_files, source_url, search_count, full_text_token_limit, use_notion_index=False) -> str:
+    """参考情報の取得元を表すフィンガープリントを返します。
+
+    ファイルは内容のハッシュ、URLはそのまま、Web検索は検索設定で識別するため、キャッシュヒット時は情報収集自体を省略できます。
+    """
+    if uploaded_files:
+        digests = [
+            f"{f.name}:{hashlib.sha256(f.getvalue()).hexdigest()}" for f in uploaded_files
+        ]
+        return "files:" + ",".join(digests)
+    if source_url:
+        return f"url:{source_url}"
+    if use_notion_index:
+        return f"notion_index:{search_count}:{full_text_token_limit}"
+    return f"web:{search_count}:{full_text_token_limit}"
+
+
+def make_key(*parts) -> str:
+    """モデル名・ペルソナ・プロンプト・コンテキストなどからキャッシュキーを計算します。"""
+    payload = json.dumps(parts, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get(key: str):
+    """キャッシュ済みの (タイトル, 本文) を返します。存在しないか期限切れの場合は None を返します。"""
+    with _lock:
+        item = _results.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.time():
+            del _results[key]
+            return None
+        _results.move_to_end(key)
+        return value
+
+
+def put(key: str, title: str, content: str):
+    """生成結果を保存します。上限を超えた場合は最も古く使われたものから削除します。"""
+    with _lock:
+        _results[key] = (time.time() + GENERATION_CACHE_TTL, (title, content))
+        _results.move_to_end(key)
+        while len(_results) > GENERATION_CACHE_MAX_ENTRIES:
+            _results.popitem(last=False)
+
+
+def invalidate(key: str):
+    """指定したキーのキャッシュを削除します。"""
+    with _lock:
+        _results.pop(key, None)
@@ -0,0 +1,133 @@
+import os
+import socket
+import http.cookiejar
+import threading
+import time
+import logging
+
+import httpcore
+import httpx
+
+import usage_meter
+
+# Webページ取得に使う共通ヘッダー
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/115.0',
+}
+
+# --- 接続プールの設定 (環境変数で上書き可能) ---
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15.0"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60.0"))
+HTTP_DNS_CACHE_TTL = float(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class _CachingDNSBackend(httpcore.SyncBackend):
+    """名前解決の結果をTTL付きでキャッシュするネットワークバックエンド。
+
+    TLSのSNIや証明書検証はhttpcoreが元のホスト名で行うため、ここではTCP接続先のIPだけを差し替えます。
+    """
+
+    def __init__(self, ttl: float):
+        super().__init__()
+        self._ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _resolve(self, host: str, port: int) -> list:
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] > now:
+                return cached[1]
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        with self._lock:
+            self._cache[key] = (now + self._ttl, addresses)
+        return addresses
+
+    def connect_tcp(self, host, port, *args, **kwargs):
+        try:
+            addresses = self._resolve(host, port)
+        except OSError:
+            # 名前解決に失敗した場合は通常の経路に任せる
+            return super().connect_tcp(host, port, *args, **kwargs)
+        last_error = None
+        for address in addresses:
+            try:
+                return super().connect_tcp(address, port, *args, **kwargs)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                last_error = e
+        with self._lock:
+            self._cache.pop((host, port), None)
+        raise last_error
+
+
+class _DiscardCookiePolicy(http.cookiejar.DefaultCookiePolicy):
+    """レスポンスのCookieを保存しないポリシー。
+
+    共有クライアントはユーザーや実行をまたいで使うため、あるユーザーの取得で設定されたCookieが
+    他のユーザーの取得で送信されたり、長時間動くプロセスでCookieが増え続けたりしないようにします。
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _create_client() -> httpx.Client:
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    http2 = _http2_available()
+    transport = httpx.HTTPTransport(http2=http2, limits=limits, retries=1)
+    # httpxはネットワークバックエンドを公開していないため、内部プールが存在する場合のみ差し替える
+    pool = getattr(transport, '_pool', None)
+    if HTTP_DNS_CACHE_TTL > 0 and pool is not None and hasattr(pool, '_network_backend'):
+        pool._network_backend = _CachingDNSBackend(HTTP_DNS_CACHE_TTL)
+    logging.info(f"Shared HTTP client created (http2={http2}, max_connections={HTTP_MAX_CONNECTIONS}).")
+    return httpx.Client(
+        headers=DEFAULT_HEADERS,
+        follow_redirects=True,
+        timeout=HTTP_TIMEOUT,
+        transport=transport,
+        # 共有するのは接続プールだけにし、Cookieは保持しない（リクエストごとに新しいクライアントを作っていた頃と同じ扱い）
+        cookies=http.cookiejar.CookieJar(policy=_DiscardCookiePolicy()),
+        event_hooks=usage_meter.event_hooks('web_fetches'),
+    )
+
+
+def get_http_client() -> httpx.Client:
+    """プロセス全体で共有する接続プール付きのHTTPクライアントを返します。
+
+    ユーザーや実行をまたいでTLSセッションとKeep-Alive接続を再利用します。Cookieは保存しません。スレッドセーフです。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _create_client()
+    return _client
+
+
+def close_http_client():
+    """共有クライアントを閉じます。次回の get_http_client() で作り直されます。"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
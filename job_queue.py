@@ -0,0 +1,333 @@
+import os
+import io
+import json
+import time
+import sqlite3
+import socket
+import uuid
+import hashlib
+import logging
+import threading
+import traceback
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import core_logic
+from gemini_governor import batch_priority
+import usage_meter
+import run_profiler
+
+# --- バックグラウンドジョブの設定 (環境変数で上書き可能) ---
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# 実行中のジョブのハートビートを更新し、止まったジョブを探す間隔（秒）
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+# この秒数よりハートビートが途絶えた実行中ジョブは、担当プロセスが落ちたものとみなして再開する
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))
+
+# ジョブを実行中のプロセスの識別子（ホスト名:PID:起動ごとのトークン）。複数のレプリカが同じDBを共有しても区別でき、
+# コンテナの再起動でホスト名とPIDが前回と同じになっても、前回のプロセスとは区別できる
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+_RUNNERS = {
+    'new': core_logic.run_new_page_process,
+    'edit': core_logic.run_edit_page_process,
+    'patch': core_logic.run_patch_page_process,
+}
+
+_executor = None
+_client_factory = None
+_start_lock = threading.Lock()
+_heartbeat_thread = None
+# このプロセスのワーカープールに投入済みで、まだ開始していないジョブ
+_local_pending = set()
+_local_lock = threading.Lock()
+
+
+class StoredUpload(io.BytesIO):
+    """キューに保存したファイルを st.file_uploader の戻り値と同じように扱うためのクラス。"""
+
+    def __init__(self, name: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+
+
+class JobReporter:
+    """status_placeholder / results_placeholder の代わりに、進捗をジョブのレコードへ書き込みます。"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+
+    def info(self, message):
+        _update(self.job_id, progress=str(message))
+
+    warning = info
+    success = info
+
+    def error(self, message):
+        _update(self.job_id, progress=str(message), error=str(message))
+
+    def container(self, **kwargs):
+        return contextlib.nullcontext()
+
+
+class JobCheckpoint:
+    """ジョブの途中経過（作成したページID・生成した本文・書き込み済みの位置など）をジョブのレコードに保存します。
+
+    再開されたジョブはこの内容を読み、済んでいる処理を繰り返さずに続きから実行します。
+    """
+
+    def __init__(self, job_id: str, data: dict):
+        self.job_id = job_id
+        self._data = data
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def save(self, **fields):
+        self._data.update(fields)
+        _update(self.job_id, checkpoint=json.dumps(self._data, ensure_ascii=False))
+
+
+@contextlib.contextmanager
+def _connect():
+    conn = sqlite3.connect(JOB_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _init_db():
+    with _connect() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        # 既存のDBには、ハートビートとチェックポイントの列を後から追加する
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for name, definition in (('owner', 'TEXT'), ('heartbeat_at', 'REAL'), ('checkpoint', 'TEXT')):
+            if name not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (username, created_at)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_files (
+                job_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (job_id, position)
+            )
+        """)
+
+
+def _update(job_id: str, **fields):
+    fields['updated_at'] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with _connect() as conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+def _job_id(username: str, kind: str, params: dict, files: list) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([username, kind, params], ensure_ascii=False, sort_keys=True).encode('utf-8'))
+    for name, data in files:
+        hasher.update(name.encode('utf-8'))
+        hasher.update(hashlib.sha256(data).digest())
+    return hasher.hexdigest()[:16]
+
+
+def _process_alive(owner: str) -> bool:
+    """owner が同じホストのプロセスであれば、そのプロセスが生きているかを返します（別ホストの場合は True）。"""
+    parts = (owner or "").rsplit(":", 2)
+    if len(parts) != 3 or parts[0] != socket.gethostname() or not parts[1].isdigit():
+        return True
+    if int(parts[1]) == os.getpid():
+        # PIDが同じでもトークンが違えば、再起動前のプロセスのジョブ
+        return owner == WORKER_ID
+    pid = parts[1]
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def sweep() -> int:
+    """自分が実行中のジョブのハートビートを更新し、止まったジョブを再キューして、このプロセスで再開したジョブ数を返します。
+
+    ハートビートが JOB_STALE_SECONDS 以上途絶えたジョブと、同じホストで担当プロセスが終了しているジョブを再開します。
+    担当者のいない待機中のジョブ（登録したレプリカが落ちたもの）も拾います。ジョブの取得は _run_job で排他的に行います。
+    """
+    now = time.time()
+    with _connect() as conn:
+        conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status = 'running'", (now, WORKER_ID))
+        running = conn.execute(
+            "SELECT id, owner, heartbeat_at FROM jobs WHERE status = 'running' AND owner IS NOT ?", (WORKER_ID,)
+        ).fetchall()
+        stale = [
+            row['id'] for row in running
+            if (row['heartbeat_at'] or 0) < now - JOB_STALE_SECONDS or not _process_alive(row['owner'])
+        ]
+        for job_id in stale:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, progress = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                ("中断されたジョブを再開します", now, job_id),
+            )
+        queued = [row['id'] for row in conn.execute(
+            "SELECT id FROM jobs WHERE status = 'queued' AND (id IN ({}) OR updated_at < ?) ORDER BY created_at".format(
+                ", ".join("?" * len(stale))
+            ),
+            (*stale, now - JOB_STALE_SECONDS),
+        )]
+    queued = [job_id for job_id in queued if _enqueue(job_id)]
+    if queued:
+        logging.info(f"Resumed {len(queued)} background job(s).")
+    return len(queued)
+
+
+def _enqueue(job_id: str) -> bool:
+    """ジョブをこのプロセスのワーカープールに投入します。投入済みで未開始の場合は何もせず False を返します。"""
+    with _local_lock:
+        if job_id in _local_pending:
+            return False
+        _local_pending.add(job_id)
+    _executor.submit(_run_job, job_id)
+    return True
+
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            sweep()
+        except Exception as e:
+            logging.warning(f"Background job heartbeat failed: {e}")
+
+
+def start_workers(client_factory):
+    """ワーカープールを起動し、中断されたジョブを再開します。プロセスごとに1回だけ呼び出してください。
+
+    client_factory はユーザー名を受け取り、notion_client / gemini_model / gemini_lite_model / current_user
+    を属性に持つオブジェクトを返す関数です。APIキーはキューに保存せず、実行時にこの関数から取得します。
+    """
+    global _executor, _client_factory, _heartbeat_thread
+    with _start_lock:
+        _client_factory = client_factory
+        if _executor is not None:
+            return
+        _init_db()
+        _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job-worker")
+        sweep()
+        # 起動時だけでなく定期的に確認し、後から止まったジョブや他のレプリカで止まったジョブも再開する
+        _heartbeat_thread = threading.Thread(target=_heartbeat_loop, name="job-heartbeat", daemon=True)
+        _heartbeat_thread.start()
+
+
+def submit(username: str, kind: str, params: dict, uploaded_files=None) -> str:
+    """ジョブをキューに登録してジョブIDを返します。
+
+    同じ内容のジョブが待機中・実行中であれば新しく登録せず、そのジョブのIDを返します。
+    """
+    if kind not in _RUNNERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    files = [(f.name, f.getvalue()) for f in uploaded_files or []]
+    job_id = _job_id(username, kind, params, files)
+    now = time.time()
+    with _connect() as conn:
+        row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is not None and row['status'] in ACTIVE_STATUSES:
+            return job_id
+        if row is None:
+            conn.execute(
+                "INSERT INTO jobs (id, username, kind, params, status, progress, created_at, updated_at) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, username, kind, json.dumps(params, ensure_ascii=False), "実行待ち", now, now),
+            )
+        else:
+            # 失敗したジョブの再登録ではチェックポイントから続け、成功済みのジョブの再登録では最初からやり直す
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', progress = ?, error = NULL, owner = NULL, created_at = ?, updated_at = ?, "
+                "checkpoint = CASE WHEN status = 'succeeded' THEN NULL ELSE checkpoint END WHERE id = ?",
+                ("実行待ち", now, now, job_id),
+            )
+            conn.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+        conn.executemany(
+            "INSERT INTO job_files (job_id, position, name, data) VALUES (?, ?, ?, ?)",
+            [(job_id, i, name, data) for i, (name, data) in enumerate(files)],
+        )
+    _enqueue(job_id)
+    return job_id
+
+
+def _run_job(job_id: str):
+    with _local_lock:
+        _local_pending.discard(job_id)
+    with _connect() as conn:
+        claimed = conn.execute(
+            "UPDATE jobs SET status = 'running', owner = ?, heartbeat_at = ?, attempts = attempts + 1, updated_at = ? "
+            "WHERE id = ? AND status = 'queued'",
+            (WORKER_ID, time.time(), time.time(), job_id),
+        ).rowcount
+        if not claimed:
+            return
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        files = conn.execute("SELECT name, data FROM job_files WHERE job_id = ? ORDER BY position", (job_id,)).fetchall()
+
+    reporter = JobReporter(job_id)
+    checkpoint = JobCheckpoint(job_id, json.loads(row['checkpoint'] or '{}'))
+    params = json.loads(row['params'])
+    uploads = [StoredUpload(f['name'], f['data']) for f in files]
+    try:
+        clients = _client_factory(row['username'])
+        with usage_meter.metered_run(row['username']), core_logic.use_clients(clients), core_logic.use_checkpoint(checkpoint), \
+                batch_priority(), run_profiler.profiled_run(row['kind'], row['username'], enabled=run_profiler.is_enabled()):
+            succeeded = _RUNNERS[row['kind']](
+                **params, uploaded_files=uploads, status_placeholder=reporter, results_placeholder=reporter
+            )
+        if succeeded:
+            # 完了したジョブのチェックポイントは不要になる
+            _update(job_id, status='succeeded', checkpoint=None)
+            with _connect() as conn:
+                conn.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+        else:
+            _update(job_id, status='failed')
+    except Exception as e:
+        logging.error(f"Background job {job_id} failed: {e}")
+        _update(job_id, status='failed', progress=f"❌ ジョブの実行中にエラーが発生しました: {e}", error=traceback.format_exc())
+
+
+def get_job(job_id: str):
+    """ジョブの状態を辞書で返します。存在しない場合は None を返します。"""
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT id, username, kind, status, progress, error, attempts, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def list_jobs(username: str, limit: int = 20) -> list:
+    """ユーザーの最近のジョブを新しい順に返します。"""
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT id, kind, status, progress, error, attempts, created_at, updated_at FROM jobs WHERE username = ? ORDER BY created_at DESC LIMIT ?",
+            (username, limit),
+        ).fetchall()
+    return [dict(row) for row in rows]
@@ -0,0 +1,98 @@
+import os
+import re
+import unicodedata
+
+# --- 長文モードの設定 (環境変数で上書き可能) ---
+LONG_FORM_MAX_SECTIONS = int(os.getenv("LONG_FORM_MAX_SECTIONS", "12"))
+# セクションを同時に生成する数（Geminiの流量は GovernedModel の予算で制限される）
+LONG_FORM_CONCURRENCY = int(os.getenv("LONG_FORM_CONCURRENCY", "5"))
+# 参考情報を分割するチャンクの目安の文字数と、1セクションに渡す参考情報の上限文字数
+LONG_FORM_CHUNK_CHARS = int(os.getenv("LONG_FORM_CHUNK_CHARS", "1500"))
+LONG_FORM_SECTION_CONTEXT_CHARS = int(os.getenv("LONG_FORM_SECTION_CONTEXT_CHARS", "8000"))
+
+_SOURCE_HEADER = re.compile(r"^--- 参考.*---$")
+
+
+def parse_outline(text: str, fallback_title: str):
+    """AIが出力したアウトラインを (タイトル, 導入文, [{'heading', 'points'}]) に変換します。
+
+    形式は「タイトル：」「導入：」の行と、「## 見出し」に続く「- 要点」の行です。
+    """
+    title = fallback_title
+    intro = []
+    sections = []
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line:
+            continue
+        if line.startswith(("タイトル：", "タイトル:")):
+            # 先頭のラベルだけを取り除き、タイトル中のコロン（「Python: 入門」など）は残す
+            title = re.sub(r"^タイトル[：:]\s*", "", line).strip() or fallback_title
+        elif line.startswith("## "):
+            sections.append({'heading': line[3:].strip(), 'points': []})
+        elif sections and line.startswith(("- ", "* ")):
+            sections[-1]['points'].append(line[2:].strip())
+        elif not sections:
+            intro.append(re.sub(r"^導入[：:]\s*", "", line))
+    return title, "\n".join(intro).strip(), sections[:LONG_FORM_MAX_SECTIONS]
+
+
+def split_chunks(context: str) -> list:
+    """参考情報を行単位で LONG_FORM_CHUNK_CHARS 文字程度のチャンクに分けます。
+
+    各チャンクの先頭には、元になった参考資料・記事の見出し行（「--- 参考… ---」）を付けて出典を残します。
+    """
+    chunks = []
+    header = ""
+    current = []
+    size = 0
+    for line in context.splitlines():
+        if _SOURCE_HEADER.match(line.strip()):
+            if current:
+                chunks.append("\n".join(current))
+            header = line.strip()
+            current, size = [header], len(header)
+            continue
+        if not line.strip():
+            continue
+        if size + len(line) > LONG_FORM_CHUNK_CHARS and len(current) > 1:
+            chunks.append("\n".join(current))
+            current = [header] if header else []
+            size = len(header)
+        current.append(line)
+        size += len(line) + 1
+    if current and (len(current) > 1 or not header):
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _bigrams(text: str) -> set:
+    normalized = re.sub(r"\s+", "", unicodedata.normalize("NFKC", text).lower())
+    return {normalized[i:i + 2] for i in range(len(normalized) - 1)}
+
+
+def select_chunks(chunks: list, query: str, char_budget: int = None) -> str:
+    """query（見出しと要点）と文字バイグラムが多く重なるチャンクを、上限文字数まで元の順序で連結して返します。"""
+    char_budget = char_budget or LONG_FORM_SECTION_CONTEXT_CHARS
+    if sum(len(chunk) for chunk in chunks) <= char_budget:
+        return "\n\n".join(chunks)
+    query_bigrams = _bigrams(query)
+    scored = sorted(range(len(chunks)), key=lambda i: -len(query_bigrams & _bigrams(chunks[i])))
+    selected = []
+    used = 0
+    for i in scored:
+        if used + len(chunks[i]) > char_budget:
+            continue
+        selected.append(i)
+        used += len(chunks[i])
+    if not selected and scored:
+        return chunks[scored[0]][:char_budget]
+    return "\n\n".join(chunks[i] for i in sorted(selected))
+
+
+def strip_repeated_heading(content: str, heading: str) -> str:
+    """セクション本文の先頭で見出しが繰り返されている場合は取り除きます。"""
+    lines = content.strip().splitlines()
+    if lines and lines[0].lstrip("#").strip() == heading.strip():
+        lines = lines[1:]
+    return "\n".join(lines).strip()
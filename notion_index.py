@@ -0,0 +1,218 @@
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import usage_meter
+from notion_utils import get_all_databases, notion_blocks_to_markdown, client_fingerprint, page_title, list_all_blocks
+
+# --- ワークスペース索引の設定 (環境変数で上書き可能) ---
+NOTION_INDEX_PATH = os.getenv("NOTION_INDEX_PATH", "notion_index.sqlite3")
+# ページ本文の取得を並列に行う数（NotionのAPIは平均3リクエスト/秒程度に制限されている）
+NOTION_INDEX_SYNC_WORKERS = int(os.getenv("NOTION_INDEX_SYNC_WORKERS", "3"))
+# 検索クエリに使うトライグラムの最大数
+NOTION_INDEX_MAX_QUERY_TERMS = int(os.getenv("NOTION_INDEX_MAX_QUERY_TERMS", "64"))
+# 検索クエリのトライグラムのうち、この割合以上をタイトルか本文に含むページだけを関連するページとみなす
+NOTION_INDEX_MIN_TERM_RATIO = float(os.getenv("NOTION_INDEX_MIN_TERM_RATIO", "0.5"))
+# 関連度の判定にかける候補の数（返す件数に対する倍率）
+NOTION_INDEX_CANDIDATE_FACTOR = int(os.getenv("NOTION_INDEX_CANDIDATE_FACTOR", "4"))
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+@contextlib.contextmanager
+def _connect():
+    conn = sqlite3.connect(NOTION_INDEX_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _init_db():
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        with _connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # 日本語は分かち書きされないため、trigramトークナイザーで部分一致検索できるようにする
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5(
+                    title, content,
+                    owner UNINDEXED, page_id UNINDEXED, database_id UNINDEXED, last_edited_time UNINDEXED,
+                    tokenize = 'trigram'
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    owner TEXT NOT NULL,
+                    database_id TEXT NOT NULL,
+                    last_edited_time TEXT NOT NULL,
+                    synced_at REAL NOT NULL,
+                    PRIMARY KEY (owner, database_id)
+                )
+            """)
+        _initialized = True
+
+
+def _query_changed_pages(_notion_client, database_id: str, since):
+    """since 以降に編集されたページを、ページネーションをたどってすべて取得します。"""
+    kwargs = {'database_id': database_id, 'sorts': [{'timestamp': 'last_edited_time', 'direction': 'ascending'}]}
+    if since:
+        kwargs['filter'] = {'timestamp': 'last_edited_time', 'last_edited_time': {'on_or_after': since}}
+    pages = []
+    while True:
+        response = _notion_client.databases.query(**kwargs)
+        pages.extend(response.get('results', []))
+        if not response.get('has_more'):
+            return pages
+        kwargs['start_cursor'] = response.get('next_cursor')
+
+
+def _read_page(_notion_client, page: dict) -> dict:
+    blocks = list_all_blocks(_notion_client, page['id'])
+    return {
+        'page_id': page['id'],
+        'title': page_title(page),
+        'content': notion_blocks_to_markdown(blocks, _notion_client),
+        'last_edited_time': page.get('last_edited_time', ''),
+    }
+
+
+def sync(_notion_client, full: bool = False, progress=None) -> int:
+    """アクセス可能な全データベースのページを索引に取り込み、更新したページ数を返します。
+
+    前回の同期以降に last_edited_time が更新されたページだけを取得します。full=True の場合は索引を作り直します
+    （差分同期ではアーカイブ・削除されたページを検知できないため）。progress には (完了数, 総数) を受け取る関数を渡せます。
+    """
+    _init_db()
+    owner = client_fingerprint(_notion_client)
+    if full:
+        with _connect() as conn:
+            conn.execute("DELETE FROM pages WHERE owner = ?", (owner,))
+            conn.execute("DELETE FROM sync_state WHERE owner = ?", (owner,))
+
+    with _connect() as conn:
+        state = {row['database_id']: row['last_edited_time'] for row in conn.execute(
+            "SELECT database_id, last_edited_time FROM sync_state WHERE owner = ?", (owner,)
+        )}
+
+    changed = []
+    for database in get_all_databases(_notion_client):
+        try:
+            pages = _query_changed_pages(_notion_client, database['id'], state.get(database['id']))
+        except Exception as e:
+            logging.warning(f"Notion index: failed to query database {database['id']}: {e}")
+            continue
+        changed.extend((database['id'], page) for page in pages)
+
+    updated = 0
+    latest = dict(state)
+    # 取得に失敗したページのうち最も古い編集日時。次回の同期でそのページから取得し直せるよう、それより先に進めない
+    oldest_failed = {}
+    username = usage_meter.current_user()
+
+    def read_page(page):
+        with usage_meter.attribute_to(username):
+            return _read_page(_notion_client, page)
+
+    with ThreadPoolExecutor(max_workers=NOTION_INDEX_SYNC_WORKERS) as executor:
+        futures = [(database_id, page, executor.submit(read_page, page)) for database_id, page in changed]
+        for database_id, page, future in futures:
+            try:
+                record = future.result()
+            except Exception as e:
+                logging.warning(f"Notion index: failed to read page {page['id']}: {e}")
+                edited = page.get('last_edited_time', '')
+                oldest_failed[database_id] = min(oldest_failed.get(database_id, edited), edited)
+                continue
+            with _connect() as conn:
+                conn.execute("DELETE FROM pages WHERE owner = ? AND page_id = ?", (owner, record['page_id']))
+                conn.execute(
+                    "INSERT INTO pages (title, content, owner, page_id, database_id, last_edited_time) VALUES (?, ?, ?, ?, ?, ?)",
+                    (record['title'], record['content'], owner, record['page_id'], database_id, record['last_edited_time']),
+                )
+            latest[database_id] = max(latest.get(database_id, ''), record['last_edited_time'])
+            updated += 1
+            if progress:
+                progress(updated, len(changed))
+
+    for database_id, edited in oldest_failed.items():
+        # 同期は on_or_after で問い合わせるため、失敗したページの編集日時そのものを記録すれば次回に含まれる
+        latest[database_id] = min(latest.get(database_id, ''), edited)
+
+    with _connect() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO sync_state (owner, database_id, last_edited_time, synced_at) VALUES (?, ?, ?, ?)",
+            [(owner, database_id, edited, time.time()) for database_id, edited in latest.items() if edited],
+        )
+    return updated
+
+
+def page_count(_notion_client) -> int:
+    """索引済みのページ数を返します。"""
+    _init_db()
+    with _connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM pages WHERE owner = ?", (client_fingerprint(_notion_client),)).fetchone()[0]
+
+
+def _query_terms(text: str) -> list:
+    # 空白・記号で区切った各部分から文字トライグラムを作る。2文字の語（「AI」「料金」など）はそのまま使い、
+    # 1文字の語は多くのページに一致するため使わない
+    terms = []
+    for chunk in re.findall(r"[^\W_]+", text.lower()):
+        if len(chunk) == 2:
+            terms.append(chunk)
+        terms.extend(chunk[i:i + 3] for i in range(len(chunk) - 2))
+    return list(dict.fromkeys(terms))[:NOTION_INDEX_MAX_QUERY_TERMS]
+
+
+def _term_ratio(terms: list, row) -> float:
+    text = f"{row['title']}\n{row['content']}".lower()
+    return sum(1 for term in terms if term in text) / len(terms)
+
+
+def search(_notion_client, query: str, limit: int = 5, min_term_ratio: float = None) -> list:
+    """索引から query に関連するページを関連度順に返します（title, content, page_id を持つ辞書のリスト）。
+
+    query にはリクエスト文全体ではなく、トピックやキーワードを渡してください。トライグラムのOR検索は
+    「について」のような汎用的な語でも一致するため、クエリのトライグラムのうち min_term_ratio 以上を含まない
+    ページは除きます。関連するページがない場合は空のリストを返します。
+    """
+    _init_db()
+    terms = _query_terms(query)
+    if not terms:
+        return []
+    min_term_ratio = NOTION_INDEX_MIN_TERM_RATIO if min_term_ratio is None else min_term_ratio
+    owner = client_fingerprint(_notion_client)
+    candidate_limit = limit * NOTION_INDEX_CANDIDATE_FACTOR
+    trigrams = [term for term in terms if len(term) >= 3]
+    short_terms = [term for term in terms if len(term) < 3]
+    rows = []
+    with _connect() as conn:
+        if trigrams:
+            match = " OR ".join('"' + term.replace('"', '""') + '"' for term in trigrams)
+            rows.extend(conn.execute(
+                "SELECT page_id, title, content FROM pages WHERE pages MATCH ? AND owner = ? ORDER BY bm25(pages, 5.0, 1.0) LIMIT ?",
+                (match, owner, candidate_limit),
+            ).fetchall())
+        if short_terms:
+            # trigramトークナイザーは3文字未満の語を索引から検索できないため、部分一致で探す（MATCH とは OR で組み合わせられない）
+            conditions = " OR ".join("instr(lower(title || ' ' || content), ?) > 0" for _ in short_terms)
+            rows.extend(conn.execute(
+                f"SELECT page_id, title, content FROM pages WHERE owner = ? AND ({conditions}) LIMIT ?",
+                (owner, *short_terms, candidate_limit),
+            ).fetchall())
+    pages = {}
+    for row in rows:
+        if row['page_id'] not in pages and _term_ratio(terms, row) >= min_term_ratio:
+            pages[row['page_id']] = dict(row)
+    return list(pages.values())[:limit]
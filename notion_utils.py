@@ -1,8 +1,101 @@
 import streamlit as st
-import notion_client
+import os
 import re
+import time
+import random
+import hashlib
+import inspect
+import threading
+from typing import TYPE_CHECKING
 
-@st.cache_data(ttl=600)
+from cache_backend import cached, make_key
+
+if TYPE_CHECKING:
+    import notion_client
+
+# Notion APIの平均リクエスト数の上限（リクエスト/秒）
+NOTION_REQUESTS_PER_SECOND = float(os.getenv("NOTION_REQUESTS_PER_SECOND", "3"))
+NOTION_MAX_RETRIES = int(os.getenv("NOTION_MAX_RETRIES", "3"))
+
+class _RateLimiter:
+    """スレッドセーフなトークンバケット。"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class RateLimitedNotion:
+    """Notionクライアントをラップし、APIの呼び出しを流量制限します。rate_limited エラーは待ってから再試行します。
+
+    client.blocks.children.list(...) のような入れ子のエンドポイントにも適用されます。
+    """
+
+    def __init__(self, target, limiter: _RateLimiter = None):
+        self._target = target
+        self._limiter = limiter or _RateLimiter(NOTION_REQUESTS_PER_SECOND)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if isinstance(attr, (str, bytes, int, float, bool, dict, list, tuple, type(None))):
+            return attr
+        if inspect.isroutine(attr):
+            def call(*args, **kwargs):
+                for attempt in range(NOTION_MAX_RETRIES + 1):
+                    self._limiter.acquire()
+                    try:
+                        return attr(*args, **kwargs)
+                    except Exception as e:
+                        if getattr(e, 'code', None) != 'rate_limited' or attempt == NOTION_MAX_RETRIES:
+                            raise
+                        time.sleep(random.uniform(0.5, 1.0) * (2 ** attempt))
+            return call
+        return RateLimitedNotion(attr, self._limiter)
+
+def client_fingerprint(_notion_client) -> str:
+    """Notionクライアントの認証情報を識別するハッシュを返します（トークンそのものは保存しません）。"""
+    auth = getattr(getattr(_notion_client, 'options', None), 'auth', None) or ''
+    return hashlib.sha256(auth.encode('utf-8')).hexdigest()
+
+def _client_key(_notion_client, *args):
+    """Notionの認証情報ごとにキャッシュを分けるためのキーを返します。"""
+    return make_key(client_fingerprint(_notion_client), *args)
+
+def page_title(page: dict, default: str = '無題のページ') -> str:
+    """ページオブジェクトのタイトルプロパティから、タイトル文字列を取り出します。"""
+    title_property = next((prop for prop in page.get('properties', {}).values() if prop['type'] == 'title'), None)
+    if not title_property or not title_property.get('title'):
+        return default
+    return "".join(rt.get('plain_text', '') for rt in title_property['title']) or default
+
+def list_all_blocks(_notion_client, block_id: str) -> list:
+    """ページ（ブロック）直下の子ブロックを、ページネーションをたどってすべて取得します。"""
+    blocks = []
+    cursor = None
+    while True:
+        kwargs = {'block_id': block_id}
+        if cursor:
+            kwargs['start_cursor'] = cursor
+        response = _notion_client.blocks.children.list(**kwargs)
+        blocks.extend(response.get('results', []))
+        if not response.get('has_more'):
+            return blocks
+        cursor = response.get('next_cursor')
+
+@cached("notion_databases", ttl=600, key_func=_client_key)
 def get_all_databases(_notion_client):
     """APIキーがアクセス可能なデータベースの一覧を取得します。"""
     try:
@@ -20,7 +113,7 @@ def get_all_databases(_notion_client):
         st.error(f"Notionのデータベース検索中にAPIエラーが発生しました: {e}")
         return []
 
-@st.cache_data(ttl=300)
+@cached("notion_pages", ttl=300, key_func=_client_key)
 def get_pages_in_database(_notion_client, db_id):
     """指定されたデータベース内のページ一覧を取得します。"""
     try:
@@ -35,7 +128,7 @@ def get_pages_in_database(_notion_client, db_id):
     except Exception:
         return []
 
-def notion_blocks_to_markdown(blocks: list, _notion_client: notion_client.Client) -> str:
+def notion_blocks_to_markdown(blocks: list, _notion_client: "notion_client.Client") -> str:
     """Notionブロックのリストをマークダウン文字列に変換します。"""
     # （この関数の内容は変更なし）
     def rich_text_to_markdown(rich_text: list) -> str:
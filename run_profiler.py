@@ -0,0 +1,187 @@
+import os
+import io
+import json
+import time
+import uuid
+import shutil
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+import contextlib
+
+# --- 実行プロファイルの設定 (環境変数で上書き可能) ---
+# "1" の場合はすべての生成処理（バックグラウンドジョブを含む）をプロファイルする
+RUN_PROFILER_ENABLED = os.getenv("RUN_PROFILER_ENABLED", "0") == "1"
+# サイドバーからプロファイルを有効にできるユーザー（カンマ区切り）
+RUN_PROFILER_ADMINS = {name.strip() for name in os.getenv("RUN_PROFILER_ADMINS", "").split(",") if name.strip()}
+RUN_PROFILE_DIR = os.getenv("RUN_PROFILE_DIR", "run_profiles")
+RUN_PROFILE_TOP_N = int(os.getenv("RUN_PROFILE_TOP_N", "25"))
+# 保存しておくプロファイルの数（古いものから削除する）
+RUN_PROFILE_KEEP = int(os.getenv("RUN_PROFILE_KEEP", "50"))
+RUN_PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("RUN_PROFILE_TRACEMALLOC_FRAMES", "1"))
+
+# tracemalloc はプロセス全体で1つのため、同時にプロファイルしている実行の数を数えて開始・停止する
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+
+def is_admin(username: str) -> bool:
+    return username in RUN_PROFILER_ADMINS
+
+
+def is_enabled(session_toggle: bool = False) -> bool:
+    """環境変数またはサイドバーの切り替えで、プロファイルが有効になっているかを返します。"""
+    return RUN_PROFILER_ENABLED or session_toggle
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(RUN_PROFILE_TRACEMALLOC_FRAMES)
+                _tracemalloc_owned = True
+            tracemalloc.reset_peak()
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    """スナップショットとピークを取得し、他にプロファイル中の実行がなければ tracemalloc を停止します。"""
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        _tracemalloc_users -= 1
+        shared = _tracemalloc_users > 0
+        if not shared and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+    return snapshot, peak, shared
+
+
+def _top_functions(profiler: cProfile.Profile) -> list:
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, lineno, function), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            'function': f"{os.path.basename(filename)}:{lineno}({function})",
+            'ncalls': ncalls,
+            'tottime': round(tottime, 4),
+            'cumtime': round(cumtime, 4),
+        })
+    rows.sort(key=lambda row: -row['cumtime'])
+    return rows[:RUN_PROFILE_TOP_N]
+
+
+def _top_allocations(snapshot) -> list:
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    return [
+        {
+            'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            'size_kib': round(stat.size / 1024, 1),
+            'count': stat.count,
+        }
+        for stat in snapshot.statistics('lineno')[:RUN_PROFILE_TOP_N]
+    ]
+
+
+def _prune():
+    runs = sorted(os.listdir(RUN_PROFILE_DIR))
+    for run_id in runs[:max(0, len(runs) - RUN_PROFILE_KEEP)]:
+        shutil.rmtree(os.path.join(RUN_PROFILE_DIR, run_id), ignore_errors=True)
+
+
+@contextlib.contextmanager
+def profiled_run(kind: str, username: str, enabled: bool = True):
+    """with ブロック内の処理のCPUプロファイルとメモリ割り当てを記録し、実行IDごとに保存します。
+
+    as で受け取る辞書の 'run_id' に、保存したプロファイルの実行IDが入ります（無効な場合は None のまま）。
+    cProfile は呼び出し元のスレッドだけを計測するため、ワーカースレッドでの処理は待ち時間としてのみ現れます。
+    """
+    result = {'run_id': None}
+    if not enabled:
+        yield result
+        return
+
+    run_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+    profiler = cProfile.Profile()
+    started_at = time.time()
+    wall_started = time.perf_counter()
+    cpu_started = time.thread_time()
+    _start_tracemalloc()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Python 3.12以降は、別のスレッドで他の実行をプロファイル中の場合に同時に有効にできない
+        logging.warning(f"Run profiler: CPU profile unavailable for {run_id}: {e}")
+        profiler = None
+    try:
+        yield result
+    finally:
+        if profiler:
+            profiler.disable()
+        wall_seconds = time.perf_counter() - wall_started
+        cpu_seconds = time.thread_time() - cpu_started
+        snapshot, peak, shared = _stop_tracemalloc()
+        try:
+            run_dir = os.path.join(RUN_PROFILE_DIR, run_id)
+            os.makedirs(run_dir, exist_ok=True)
+            if profiler:
+                profiler.dump_stats(os.path.join(run_dir, "profile.prof"))
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(RUN_PROFILE_TOP_N * 2)
+                with open(os.path.join(run_dir, "profile.txt"), "w", encoding="utf-8") as f:
+                    f.write(report.getvalue())
+            summary = {
+                'run_id': run_id,
+                'kind': kind,
+                'username': username,
+                'started_at': started_at,
+                'wall_seconds': round(wall_seconds, 3),
+                'cpu_seconds': round(cpu_seconds, 3),
+                'peak_mib': round(peak / (1024 * 1024), 2),
+                # 同時に別の実行もプロファイルしていた場合、メモリの数値にはその分も含まれる
+                'memory_shared': shared,
+                'top_functions': _top_functions(profiler) if profiler else [],
+                'top_allocations': _top_allocations(snapshot),
+            }
+            with open(os.path.join(run_dir, "summary.json"), "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            _prune()
+            result['run_id'] = run_id
+        except Exception as e:
+            logging.warning(f"Run profiler: failed to save profile {run_id}: {e}")
+
+
+def list_runs(username: str = None, limit: int = 20) -> list:
+    """保存済みのプロファイルの概要を新しい順に返します。username を指定した場合はそのユーザーの実行だけを返します。"""
+    if not os.path.isdir(RUN_PROFILE_DIR):
+        return []
+    summaries = []
+    for run_id in sorted(os.listdir(RUN_PROFILE_DIR), reverse=True):
+        summary = load_summary(run_id)
+        if summary and (username is None or summary.get('username') == username):
+            summaries.append(summary)
+            if len(summaries) >= limit:
+                break
+    return summaries
+
+
+def load_summary(run_id: str):
+    path = os.path.join(RUN_PROFILE_DIR, os.path.basename(run_id), "summary.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def profile_path(run_id: str) -> str:
+    """snakeviz などで開ける、pstats形式のプロファイルのパスを返します。"""
+    return os.path.join(RUN_PROFILE_DIR, os.path.basename(run_id), "profile.prof")
@@ -0,0 +1,94 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# notion_utils が streamlit を読み込むため、streamlit がない環境ではスキップする
+pytest.importorskip("streamlit")
+
+import block_patch
+from notion_utils import markdown_to_notion_blocks
+
+
+class FakePage:
+    """ブロックの並びだけを保持し、append(after=...) / update / delete を反映するNotionクライアント。"""
+
+    def __init__(self, texts, fail_at=None):
+        self.order = [(f"b{i + 1}", text) for i, text in enumerate(texts)]
+        self.blocks = self
+        self.children = self
+        self.writes = 0
+        self.fail_at = fail_at
+        self._created = 0
+
+    def _write(self):
+        # fail_at 回目の書き込みで、処理が中断されたものとして例外を送出する
+        self.writes += 1
+        if self.writes == self.fail_at:
+            self.fail_at = None
+            raise RuntimeError("interrupted")
+
+    def append(self, block_id, children, after=None):
+        self._write()
+        position = len(self.order) if after is None else [bid for bid, _ in self.order].index(after) + 1
+        added = []
+        for child in children:
+            self._created += 1
+            added.append((f"n{self._created}", child['paragraph']['rich_text'][0]['text']['content']))
+        self.order[position:position] = added
+        return {'results': [{'id': bid} for bid, _ in added]}
+
+    def update(self, block_id, **kwargs):
+        self._write()
+        text = kwargs['paragraph']['rich_text'][0]['text']['content']
+        self.order = [(bid, text if bid == block_id else old) for bid, old in self.order]
+
+    def delete(self, block_id):
+        self._write()
+        self.order = [(bid, text) for bid, text in self.order if bid != block_id]
+
+    def texts(self):
+        return [text for _, text in self.order]
+
+
+def _items(texts):
+    return [
+        {
+            'number': i + 1, 'id': f"b{i + 1}", 'type': 'paragraph', 'markdown': text,
+            'signature': block_patch.content_signature(markdown_to_notion_blocks(text)[0]), 'editable': True,
+        }
+        for i, text in enumerate(texts)
+    ]
+
+
+def _operations(texts, patch_text):
+    items = _items(texts)
+    sequence, _ = block_patch.apply_patch(items, block_patch.parse_patch(patch_text))
+    return block_patch.plan_operations(items, sequence)
+
+
+def test_insert_at_top_stays_before_later_inserts():
+    page = FakePage(["B1", "B2"])
+    operations = _operations(["B1", "B2"], "@@ insert_after 0\nTOP\n@@ insert_after 1\nAFTER1")
+    stats = block_patch.execute_operations(page, "P", operations)
+    assert stats['moved_from_top']
+    assert page.texts() == ["B1", "TOP", "AFTER1", "B2"]
+
+
+@pytest.mark.parametrize("fail_at", range(1, 5))
+def test_resume_after_interruption_matches_uninterrupted_run(fail_at):
+    texts = ["B1", "B2", "B3", "B4"]
+    patch_text = "@@ insert_after 0\nTOP\n@@ delete 2\n@@ insert_after 3\nAFTER3\n@@ replace 4\nNEW4"
+    expected = FakePage(texts)
+    block_patch.execute_operations(expected, "P", _operations(texts, patch_text))
+    assert expected.writes >= 4
+
+    page = FakePage(texts, fail_at=fail_at)
+    operations = _operations(texts, patch_text)
+    progress = {}
+    with pytest.raises(RuntimeError):
+        block_patch.execute_operations(page, "P", operations, on_progress=lambda state: progress.update(state=state))
+    block_patch.execute_operations(page, "P", operations, resume=progress.get('state'))
+    assert page.texts() == expected.texts()
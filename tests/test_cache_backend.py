@@ -0,0 +1,114 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache_backend
+
+
+class FakeRedis:
+    """redis-py と同じく bytes を返す、get / set(ex=) / incr だけを持つインメモリのRedisクライアント。"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode('utf-8') if isinstance(value, str) else value
+        self.expires[key] = ex
+
+    def incr(self, key):
+        value = int(self.data.get(key, b"0")) + 1
+        self.data[key] = str(value).encode('utf-8')
+        return value
+
+
+@pytest.fixture(params=["redis", "sqlite"])
+def shared(request, tmp_path):
+    if request.param == "redis":
+        return cache_backend.RedisTier(FakeRedis())
+    return cache_backend.SQLiteTier(str(tmp_path / "cache.sqlite3"))
+
+
+def test_value_set_in_one_process_is_read_by_another(shared):
+    writer = cache_backend.TieredCache(shared, check_interval=0)
+    reader = cache_backend.TieredCache(shared, check_interval=0)
+    writer.set("user_config", "k", {'names': ["太郎"]}, ttl=60)
+    assert reader.get("user_config", "k") == (True, {'names': ["太郎"]})
+
+
+def test_invalidate_is_seen_by_another_instance_sharing_the_tier(shared):
+    first = cache_backend.TieredCache(shared, check_interval=0)
+    second = cache_backend.TieredCache(shared, check_interval=0)
+    first.set("user_config", "k", "old", ttl=60)
+    # 2つ目のインスタンスのプロセス内LRUにも載せておく
+    assert second.get("user_config", "k") == (True, "old")
+
+    first.invalidate("user_config")
+
+    assert second.get("user_config", "k") == (False, None)
+    assert first.get("user_config", "k") == (False, None)
+    second.set("user_config", "k", "new", ttl=60)
+    assert first.get("user_config", "k") == (True, "new")
+
+
+def test_invalidate_is_seen_after_check_interval(shared, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_backend.time, "monotonic", lambda: now[0])
+    first = cache_backend.TieredCache(shared, check_interval=2.0)
+    second = cache_backend.TieredCache(shared, check_interval=2.0)
+    first.set("user_config", "k", "old", ttl=60)
+    assert second.get("user_config", "k") == (True, "old")
+
+    first.invalidate("user_config")
+    # 確認間隔の間はローカルの世代番号を信用する
+    assert second.get("user_config", "k") == (True, "old")
+    now[0] += 2.5
+    assert second.get("user_config", "k") == (False, None)
+
+
+def test_invalidate_only_affects_its_namespace(shared):
+    first = cache_backend.TieredCache(shared, check_interval=0)
+    second = cache_backend.TieredCache(shared, check_interval=0)
+    first.set("user_config", "k", 1, ttl=60)
+    first.set("notion_pages", "k", 2, ttl=60)
+    first.invalidate("user_config")
+    assert second.get("notion_pages", "k") == (True, 2)
+
+
+def test_redis_tier_sets_expiry():
+    client = FakeRedis()
+    cache = cache_backend.TieredCache(cache_backend.RedisTier(client), check_interval=0)
+    cache.set("ns", "k", "v", ttl=0.5)
+    assert list(client.expires.values()) == [1]
+
+
+def test_from_url_without_redis_package_explains_how_to_fix(monkeypatch):
+    monkeypatch.setitem(sys.modules, "redis", None)
+    with pytest.raises(RuntimeError, match="pip install redis"):
+        cache_backend.RedisTier.from_url("redis://localhost:6379/0")
+
+
+def test_local_only_values_stay_out_of_shared_tier_but_are_invalidated():
+    client = FakeRedis()
+    shared = cache_backend.RedisTier(client)
+    first = cache_backend.TieredCache(shared, check_interval=0)
+    second = cache_backend.TieredCache(shared, check_interval=0)
+    first.set("user_passwords", "k", {'taro': "$2b$12$hash"}, ttl=60, local_only=True)
+    assert not any(b"$2b$" in value for value in client.data.values())
+    assert first.get("user_passwords", "k") == (True, {'taro': "$2b$12$hash"})
+    assert second.get("user_passwords", "k") == (False, None)
+
+    second.invalidate("user_passwords")
+    assert first.get("user_passwords", "k") == (False, None)
+
+
+def test_sqlite_file_is_created_readable_only_by_owner(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    cache_backend.SQLiteTier(str(path))
+    assert path.stat().st_mode & 0o077 == 0
@@ -0,0 +1,138 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import usage_meter
+
+
+class FlakySink(usage_meter.MemorySink):
+    """指定した回数だけ書き込み・読み込みに失敗する MemorySink。"""
+
+    def __init__(self, fail_writes=0, fail_reads=0):
+        super().__init__()
+        self.fail_writes = fail_writes
+        self.fail_reads = fail_reads
+        self.reads = 0
+
+    def write(self, period, batch):
+        if self.fail_writes:
+            self.fail_writes -= 1
+            raise RuntimeError("sink unavailable")
+        super().write(period, batch)
+
+    def read(self, username, period):
+        self.reads += 1
+        if self.fail_reads:
+            self.fail_reads -= 1
+            raise RuntimeError("sink unavailable")
+        return super().read(username, period)
+
+
+@pytest.fixture
+def period(monkeypatch):
+    monkeypatch.setattr(usage_meter, "current_period", lambda: "2026-10")
+    return "2026-10"
+
+
+@pytest.fixture
+def quotas(monkeypatch):
+    limits = {'gemini_tokens': 0, 'web_fetches': 0, 'notion_calls': 0}
+    monkeypatch.setattr(usage_meter, "DEFAULT_QUOTAS", limits)
+    return limits
+
+
+def test_flush_writes_all_users_in_one_batch(period):
+    sink = usage_meter.MemorySink()
+    meter = usage_meter.UsageMeter(sink)
+    meter.record("alice", gemini_tokens=100, gemini_requests=1)
+    meter.record("alice", gemini_tokens=50, gemini_requests=1)
+    meter.record("bob", web_fetches=3)
+
+    assert meter.flush() == 2
+    assert sink.writes == 1
+    assert sink.usage[("alice", period)] == {'gemini_tokens': 150, 'gemini_requests': 2}
+    assert sink.usage[("bob", period)] == {'web_fetches': 3}
+
+    # 書き込んだ分は集計から消え、二重に加算されない
+    assert meter.flush() == 0
+    assert sink.writes == 1
+
+
+def test_failed_write_is_merged_back_and_retried(period):
+    sink = FlakySink(fail_writes=1)
+    meter = usage_meter.UsageMeter(sink)
+    meter.record("alice", gemini_tokens=100)
+
+    assert meter.flush() == 0
+    assert sink.usage == {}
+    # 失敗した分は集計に戻り、その後の記録と合算して次回に書き込まれる
+    meter.record("alice", gemini_tokens=20)
+    assert meter.usage("alice")['usage'] == {'gemini_tokens': 120}
+
+    assert meter.flush() == 1
+    assert sink.usage[("alice", period)] == {'gemini_tokens': 120}
+    assert meter.flush() == 0
+    assert sink.usage[("alice", period)] == {'gemini_tokens': 120}
+
+
+def test_usage_combines_stored_and_pending_without_double_counting(period, quotas):
+    sink = usage_meter.MemorySink()
+    sink.usage[("alice", period)] = usage_meter.Counter(notion_calls=10)
+    meter = usage_meter.UsageMeter(sink)
+    meter.record("alice", notion_calls=5)
+    assert meter.usage("alice")['usage'] == {'notion_calls': 15}
+
+    meter.flush()
+    # 読み直す前でも、書き込んだ分は保存済みの使用量に反映されている
+    assert meter.usage("alice")['usage'] == {'notion_calls': 15}
+    assert sink.usage[("alice", period)] == {'notion_calls': 15}
+
+
+def test_failed_read_keeps_last_known_usage(period, quotas, monkeypatch):
+    sink = FlakySink()
+    sink.usage[("alice", period)] = usage_meter.Counter(web_fetches=7)
+    meter = usage_meter.UsageMeter(sink)
+    assert meter.usage("alice")['usage'] == {'web_fetches': 7}
+
+    monkeypatch.setattr(usage_meter, "USAGE_QUOTA_CACHE_SECONDS", -1)
+    sink.fail_reads = 1
+    assert meter.usage("alice")['usage'] == {'web_fetches': 7}
+    assert sink.reads == 2
+
+
+def test_check_quota_uses_default_quotas(period, quotas):
+    quotas['gemini_tokens'] = 1000
+    meter = usage_meter.UsageMeter(usage_meter.MemorySink())
+    meter.record("alice", gemini_tokens=999)
+    assert meter.check_quota("alice") is None
+
+    # 未書き込みの使用量もクォータ判定に含める
+    meter.record("alice", gemini_tokens=1)
+    assert meter.check_quota("alice") == "Geminiトークン 1,000 / 1,000"
+
+
+def test_check_quota_uses_per_user_overrides(period, quotas):
+    quotas['web_fetches'] = 100
+    sink = usage_meter.MemorySink()
+    sink.quotas["alice"] = {'web_fetches': 0, 'notion_calls': 10}
+    sink.usage[("alice", period)] = usage_meter.Counter(web_fetches=500, notion_calls=12)
+    sink.usage[("bob", period)] = usage_meter.Counter(web_fetches=500)
+    meter = usage_meter.UsageMeter(sink)
+
+    # 個別のクォータ 0 は無制限として扱う
+    assert meter.check_quota("alice") == "Notion API呼び出し 12 / 10"
+    assert meter.check_quota("bob") == "Webページ取得 500 / 100"
+
+
+def test_record_is_attributed_to_the_current_user(period, monkeypatch):
+    meter = usage_meter.UsageMeter(usage_meter.MemorySink())
+    monkeypatch.setattr(usage_meter, "_meter", meter)
+    usage_meter.record(web_fetches=1)
+    with usage_meter.attribute_to("alice"):
+        usage_meter.record(web_fetches=2)
+    usage_meter.record(web_fetches=4)
+    assert meter.flush() == 1
+    assert meter.sink.usage == {("alice", period): {'web_fetches': 2}}
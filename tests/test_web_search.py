@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import web_search
+
+
+class FakeProvider:
+    """指定した秒数だけ待ってから決まった結果を返す（または例外を送出する）検索プロバイダー。"""
+
+    def __init__(self, name, urls=(), delay=0.0, error=None):
+        self.name = name
+        self.urls = list(urls)
+        self.delay = delay
+        self.error = error
+        self.started_at = None
+        self.calls = 0
+        self._release = threading.Event()
+
+    def __call__(self, query, max_results):
+        self.calls += 1
+        self.started_at = time.monotonic()
+        self._release.wait(self.delay)
+        if self.error:
+            raise self.error
+        return [{'title': url, 'href': url, 'body': ''} for url in self.urls[:max_results]]
+
+    def release(self):
+        self._release.set()
+
+
+@pytest.fixture
+def providers():
+    created = []
+
+    def make(*args, **kwargs):
+        provider = FakeProvider(*args, **kwargs)
+        created.append(provider)
+        return provider
+
+    yield make
+    # 締め切りで見捨てた遅いプロバイダーを待たせたままにしない
+    for provider in created:
+        provider.release()
+
+
+def _hrefs(results):
+    return [result['href'] for result in results]
+
+
+def test_slow_provider_is_hedged(providers):
+    slow = providers("slow", ["https://slow.example/a"], delay=2.0)
+    fast = providers("fast", ["https://fast.example/a", "https://fast.example/b"])
+    started = time.monotonic()
+    results = web_search.search("q", 2, providers=[slow, fast], hedge_delay=0.05, deadline=5)
+    assert time.monotonic() - started < 1.0
+    assert fast.started_at - slow.started_at >= 0.04
+    assert _hrefs(results) == ["https://fast.example/a", "https://fast.example/b"]
+
+
+def test_failed_provider_falls_through_without_waiting_for_hedge_delay(providers):
+    broken = providers("broken", error=RuntimeError("rate limited"))
+    backup = providers("backup", ["https://backup.example/a"])
+    started = time.monotonic()
+    results = web_search.search("q", 1, providers=[broken, backup], hedge_delay=5.0, deadline=10)
+    assert time.monotonic() - started < 1.0
+    assert _hrefs(results) == ["https://backup.example/a"]
+    assert results[0]['sources'] == ["backup"]
+
+
+def test_deadline_returns_partial_results(providers):
+    partial = providers("partial", ["https://partial.example/a", "https://partial.example/b"])
+    stuck = providers("stuck", ["https://stuck.example/a"], delay=5.0)
+    started = time.monotonic()
+    results = web_search.search("q", 10, providers=[partial, stuck], hedge_delay=0.0, deadline=0.3)
+    elapsed = time.monotonic() - started
+    assert 0.25 <= elapsed < 1.0
+    assert _hrefs(results) == ["https://partial.example/a", "https://partial.example/b"]
+
+
+def test_urls_are_normalized_deduplicated_and_filtered(providers):
+    first = providers("first", [
+        "https://www.example.com/article/?utm_source=x&utm_medium=y",
+        "https://example.com/report.pdf",
+        "ftp://example.com/file",
+        "https://other.example/page",
+    ])
+    second = providers("second", [
+        "https://example.com/article",
+        "https://example.com/article#section",
+    ])
+    results = web_search.search("q", 10, providers=[first, second], hedge_delay=0.0, deadline=5)
+    assert len(results) == 2
+    merged = results[0]
+    # 両方のプロバイダーで上位に現れた結果が先頭になる（内容は先に応答したプロバイダーのものを使う）
+    assert web_search.normalize_url(merged['href']) == "//example.com/article"
+    assert sorted(merged['sources']) == ["first", "second"]
+    assert results[1]['href'] == "https://other.example/page"
+
+
+def test_normalize_url():
+    assert web_search.normalize_url("https://WWW.Example.com/a/?utm_campaign=x&id=1&fbclid=y#top") == "//example.com/a?id=1"
+    assert web_search.normalize_url("http://example.com/a/") == web_search.normalize_url("https://www.example.com/a")
+
+
+def test_returns_as_soon_as_max_results_are_collected(providers):
+    enough = providers("enough", ["https://a.example/1", "https://a.example/2", "https://a.example/3"])
+    unused = providers("unused", ["https://b.example/1"], delay=2.0)
+    started = time.monotonic()
+    results = web_search.search("q", 3, providers=[enough, unused], hedge_delay=1.0, deadline=5)
+    assert time.monotonic() - started < 0.5
+    assert len(results) == 3
+    assert unused.calls == 0
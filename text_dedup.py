@@ -0,0 +1,101 @@
+import os
+import re
+import heapq
+import unicodedata
+
+# --- 重複除去の設定 (環境変数で上書き可能) ---
+DEDUP_ARTICLE_THRESHOLD = float(os.getenv("DEDUP_ARTICLE_THRESHOLD", "0.7"))
+DEDUP_PARAGRAPH_THRESHOLD = float(os.getenv("DEDUP_PARAGRAPH_THRESHOLD", "0.8"))
+# これより短い段落（見出しなど）は重複判定の対象にしない
+DEDUP_MIN_PARAGRAPH_CHARS = int(os.getenv("DEDUP_MIN_PARAGRAPH_CHARS", "20"))
+
+SHINGLE_SIZE = 4
+ARTICLE_SKETCH_SIZE = 128
+PARAGRAPH_SKETCH_SIZE = 16
+
+_CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af\uff66-\uff9f"
+# 日本語などの分かち書きされない文字は1文字ずつ、それ以外は単語単位でトークンにする
+_TOKEN_PATTERN = re.compile(f"[{_CJK_RANGES}]|[^\\W_{_CJK_RANGES}]+")
+_HASH_MASK = (1 << 64) - 1
+
+
+def _tokens(text: str) -> list:
+    return _TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).lower())
+
+
+def _sketch(text: str, size: int) -> set:
+    """シングル（トークンのn-gram）のハッシュのうち、小さい方から size 個を集めたMinHash（bottom-k）スケッチを返します。
+
+    ハッシュには組み込みの hash() を使うため、スケッチは同じプロセス内でのみ比較できます。
+    """
+    tokens = _tokens(text)
+    if len(tokens) < SHINGLE_SIZE:
+        shingles = {" ".join(tokens)} if tokens else set()
+    else:
+        shingles = {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+    return set(heapq.nsmallest(size, {hash(s) & _HASH_MASK for s in shingles}))
+
+
+def similarity(a: set, b: set, size: int) -> float:
+    """2つのbottom-kスケッチからJaccard係数を推定します。"""
+    if not a or not b:
+        return 0.0
+    union = heapq.nsmallest(size, a | b)
+    return sum(1 for h in union if h in a and h in b) / len(union)
+
+
+def _normalize_paragraph(paragraph: str) -> str:
+    return "".join(_tokens(paragraph))
+
+
+def dedupe_articles(articles: list):
+    """抽出した記事のリスト（{"url", "text"} の辞書）から、重複する記事と段落を取り除きます。
+
+    記事単位ではMinHashで転載・ミラーされた記事を除き、残った記事をまたいで同一・ほぼ同一の段落を除きます。
+    先に現れたもの（検索順位の高いもの）を残します。戻り値は (残った記事のリスト, 統計情報の辞書) です。
+    """
+    stats = {'duplicate_articles': 0, 'duplicate_paragraphs': 0, 'removed_chars': 0}
+
+    kept = []
+    kept_sketches = []
+    for article in articles:
+        sketch = _sketch(article['text'], ARTICLE_SKETCH_SIZE)
+        if any(similarity(sketch, other, ARTICLE_SKETCH_SIZE) >= DEDUP_ARTICLE_THRESHOLD for other in kept_sketches):
+            stats['duplicate_articles'] += 1
+            stats['removed_chars'] += len(article['text'])
+            continue
+        kept.append(article)
+        kept_sketches.append(sketch)
+
+    seen_exact = set()
+    buckets = {}
+    result = []
+    for article in kept:
+        paragraphs = []
+        for paragraph in article['text'].split("\n"):
+            normalized = _normalize_paragraph(paragraph)
+            if len(normalized) < DEDUP_MIN_PARAGRAPH_CHARS:
+                paragraphs.append(paragraph)
+                continue
+            if normalized in seen_exact:
+                stats['duplicate_paragraphs'] += 1
+                stats['removed_chars'] += len(paragraph)
+                continue
+            sketch = _sketch(paragraph, PARAGRAPH_SKETCH_SIZE)
+            # 最小ハッシュが一致する段落だけを候補として比較する（LSH）
+            keys = heapq.nsmallest(2, sketch)
+            candidates = [other for key in keys for other in buckets.get(key, [])]
+            if any(similarity(sketch, other, PARAGRAPH_SKETCH_SIZE) >= DEDUP_PARAGRAPH_THRESHOLD for other in candidates):
+                stats['duplicate_paragraphs'] += 1
+                stats['removed_chars'] += len(paragraph)
+                continue
+            seen_exact.add(normalized)
+            for key in keys:
+                buckets.setdefault(key, []).append(sketch)
+            paragraphs.append(paragraph)
+        text = "\n".join(paragraphs).strip()
+        if text:
+            result.append({**article, 'text': text})
+        else:
+            stats['duplicate_articles'] += 1
+    return result, stats
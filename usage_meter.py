@@ -0,0 +1,229 @@
+import os
+import time
+import logging
+import threading
+import contextlib
+from collections import Counter
+
+# --- 使用量計測の設定 (環境変数で上書き可能) ---
+# メモリ上の集計をまとめて書き込む間隔（秒）
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "30"))
+# クォータ判定のために保存済みの使用量を読み直す間隔（秒）
+USAGE_QUOTA_CACHE_SECONDS = float(os.getenv("USAGE_QUOTA_CACHE_SECONDS", "60"))
+# ユーザーごとの月間の上限（0 は無制限）。Firestoreのユーザー文書の usage_quota で個別に上書きできる
+DEFAULT_QUOTAS = {
+    'gemini_tokens': int(os.getenv("USAGE_QUOTA_GEMINI_TOKENS", "0")),
+    'web_fetches': int(os.getenv("USAGE_QUOTA_WEB_FETCHES", "0")),
+    'notion_calls': int(os.getenv("USAGE_QUOTA_NOTION_CALLS", "0")),
+}
+
+METRIC_LABELS = {
+    'runs': "実行回数",
+    'gemini_requests': "Gemini呼び出し",
+    'gemini_tokens': "Geminiトークン",
+    'web_fetches': "Webページ取得",
+    'notion_calls': "Notion API呼び出し",
+}
+
+_current = threading.local()
+
+
+def current_period() -> str:
+    """使用量を集計する期間（月）を返します。"""
+    return time.strftime("%Y-%m")
+
+
+class MemorySink:
+    """メモリ上に使用量を保存する書き込み先。Firestoreを使わない環境やテスト用です。"""
+
+    def __init__(self):
+        self.usage = {}
+        self.quotas = {}
+        self.writes = 0
+
+    def write(self, period: str, batch: dict):
+        self.writes += 1
+        for username, counts in batch.items():
+            self.usage.setdefault((username, period), Counter()).update(counts)
+
+    def read(self, username: str, period: str):
+        return dict(self.usage.get((username, period), {})), dict(self.quotas.get(username, {}))
+
+
+class FirestoreSink:
+    """users/{username} 文書の usage.{期間} に、Increment で加算する書き込み先。
+
+    書き込みはユーザーごとの集計を1回のバッチにまとめます。db_factory は初回の書き込み時に呼ばれます。
+    """
+
+    def __init__(self, db_factory):
+        self._db_factory = db_factory
+
+    def write(self, period: str, batch: dict):
+        from google.cloud import firestore
+        db = self._db_factory()
+        write_batch = db.batch()
+        for username, counts in batch.items():
+            user_ref = db.collection('users').document(username)
+            write_batch.set(user_ref, {'usage': {period: {k: firestore.Increment(v) for k, v in counts.items()}}}, merge=True)
+        write_batch.commit()
+
+    def read(self, username: str, period: str):
+        doc = self._db_factory().collection('users').document(username).get()
+        data = doc.to_dict() or {}
+        return dict(data.get('usage', {}).get(period, {})), dict(data.get('usage_quota', {}))
+
+
+class UsageMeter:
+    """ユーザーごとの使用量をメモリ上で集計し、一定間隔または実行の終了時にまとめて書き込みます。
+
+    record() はロックを取ってカウンタを加算するだけなので、API呼び出しの経路にはほぼ負荷をかけません。
+    """
+
+    def __init__(self, sink, flush_interval: float = USAGE_FLUSH_INTERVAL):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._persisted = {}
+        self._thread = None
+
+    def record(self, username: str, **counts):
+        with self._lock:
+            self._pending.setdefault((username, current_period()), Counter()).update(counts)
+
+    def start(self):
+        """定期的に書き込むデーモンスレッドを起動します。"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="usage-meter", daemon=True)
+            self._thread.start()
+        return self
+
+    def request_flush(self):
+        """次の周期を待たずに、バックグラウンドで書き込みます。"""
+        self._wakeup.set()
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """集計済みの使用量を期間ごとに1回の書き込みで反映し、書き込んだユーザー数を返します。
+
+        書き込みに失敗した分は集計に戻し、次回に再試行します。
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            by_period = {}
+            for (username, period), counts in pending.items():
+                by_period.setdefault(period, {})[username] = dict(counts)
+            written = 0
+            for period, batch in by_period.items():
+                try:
+                    self.sink.write(period, batch)
+                    written += len(batch)
+                except Exception as e:
+                    logging.warning(f"Usage meter: failed to write {len(batch)} users for {period}: {e}")
+                    with self._lock:
+                        for username, counts in batch.items():
+                            self._pending.setdefault((username, period), Counter()).update(counts)
+                    continue
+                # 書き込んだ分は保存済みの使用量にも加算し、次の読み直しまでクォータ判定に反映する
+                with self._lock:
+                    for username, counts in batch.items():
+                        cached = self._persisted.get((username, period))
+                        if cached:
+                            cached[1].update(counts)
+            return written
+
+    def usage(self, username: str) -> dict:
+        """今月の使用量（保存済み＋未書き込み）と、ユーザー個別のクォータを返します。"""
+        period = current_period()
+        key = (username, period)
+        cached = self._persisted.get(key)
+        if cached is None or time.monotonic() - cached[0] > USAGE_QUOTA_CACHE_SECONDS:
+            try:
+                stored, quotas = self.sink.read(username, period)
+            except Exception as e:
+                logging.warning(f"Usage meter: failed to read usage for {username}: {e}")
+                stored, quotas = (dict(cached[1]), cached[2]) if cached else ({}, {})
+            cached = (time.monotonic(), Counter(stored), quotas)
+            self._persisted[key] = cached
+        with self._lock:
+            total = cached[1] + self._pending.get(key, Counter())
+        return {'usage': dict(total), 'quotas': {**DEFAULT_QUOTAS, **cached[2]}}
+
+    def check_quota(self, username: str):
+        """今月のクォータを超えている場合はその内容を表すメッセージを、超えていない場合は None を返します。"""
+        status = self.usage(username)
+        exceeded = [
+            f"{METRIC_LABELS.get(metric, metric)} {status['usage'].get(metric, 0):,} / {limit:,}"
+            for metric, limit in status['quotas'].items()
+            if limit and status['usage'].get(metric, 0) >= limit
+        ]
+        return "、".join(exceeded) or None
+
+
+_meter = UsageMeter(MemorySink())
+
+
+def configure(sink, start: bool = True) -> UsageMeter:
+    """書き込み先を設定した計測器をプロセス全体で使うようにします。"""
+    global _meter
+    _meter = UsageMeter(sink)
+    if start:
+        _meter.start()
+    return _meter
+
+
+def get_meter() -> UsageMeter:
+    return _meter
+
+
+def current_user():
+    """現在のスレッドの使用量の帰属先ユーザーを返します。"""
+    return getattr(_current, 'username', None)
+
+
+def set_current_user(username):
+    """現在のスレッドで記録する使用量の帰属先ユーザーを設定します。"""
+    _current.username = username
+
+
+@contextlib.contextmanager
+def attribute_to(username):
+    """このスレッドで記録する使用量を、一時的に username に帰属させます。"""
+    previous = current_user()
+    _current.username = username
+    try:
+        yield
+    finally:
+        _current.username = previous
+
+
+@contextlib.contextmanager
+def metered_run(username):
+    """1回の生成処理を計測します。終了時に集計をバックグラウンドで書き込みます。"""
+    with attribute_to(username):
+        record(runs=1)
+        try:
+            yield
+        finally:
+            _meter.request_flush()
+
+
+def record(**counts):
+    """現在のスレッドの帰属先ユーザーに使用量を加算します。帰属先がない場合は何もしません。"""
+    username = current_user()
+    if username:
+        _meter.record(username, **counts)
+
+
+def event_hooks(metric: str) -> dict:
+    """httpx.Client に渡すと、リクエストごとに metric を1加算するイベントフックを返します。"""
+    return {'request': [lambda request: record(**{metric: 1})]}
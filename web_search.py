@@ -0,0 +1,120 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# --- Web検索の設定 (環境変数で上書き可能) ---
+# 問い合わせる検索バックエンドと地域（"バックエンド:地域" のカンマ区切り。先頭から順に優先）
+WEB_SEARCH_PROVIDERS = os.getenv("WEB_SEARCH_PROVIDERS", "duckduckgo:wt-wt,bing:jp-jp,brave:wt-wt,mojeek:wt-wt")
+# 先に問い合わせたバックエンドの応答が遅い場合に、次のバックエンドへ並行して問い合わせるまでの秒数
+WEB_SEARCH_HEDGE_DELAY = float(os.getenv("WEB_SEARCH_HEDGE_DELAY", "1.0"))
+# 検索全体の締め切り（秒）。締め切りまでに集まった結果だけを返す
+WEB_SEARCH_DEADLINE = float(os.getenv("WEB_SEARCH_DEADLINE", "10"))
+WEB_SEARCH_MAX_WORKERS = int(os.getenv("WEB_SEARCH_MAX_WORKERS", "8"))
+
+_TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class DDGSProvider:
+    """ddgs の指定したバックエンド・地域でテキスト検索を行うプロバイダー。
+
+    プロバイダーは name 属性を持ち、(query, max_results) を受け取って
+    title / href / body を持つ辞書のリストを返す呼び出し可能オブジェクトであれば差し替えられます。
+    """
+
+    def __init__(self, backend: str = "auto", region: str = "wt-wt"):
+        self.backend = backend
+        self.region = region
+        self.name = f"{backend}:{region}"
+
+    def __call__(self, query: str, max_results: int) -> list:
+        from ddgs import DDGS
+        return list(DDGS().text(query, region=self.region, backend=self.backend, max_results=max_results) or [])
+
+
+def default_providers() -> list:
+    """WEB_SEARCH_PROVIDERS の設定からプロバイダーのリストを作成します。"""
+    providers = []
+    for spec in WEB_SEARCH_PROVIDERS.split(","):
+        if spec.strip():
+            backend, _, region = spec.strip().partition(":")
+            providers.append(DDGSProvider(backend, region or "wt-wt"))
+    return providers
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # 締め切りを過ぎた遅い問い合わせを待たずに戻れるよう、実行ごとではなくプロセスで共有するプールを使う
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WEB_SEARCH_MAX_WORKERS, thread_name_prefix="web-search")
+        return _executor
+
+
+def normalize_url(url: str) -> str:
+    """重複判定用に、フラグメント・トラッキング用パラメータ・末尾のスラッシュなどを取り除いたURLを返します。"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query) if not k.lower().startswith(_TRACKING_PARAMS)])
+    return urlunsplit(('', host, parts.path.rstrip("/"), query, ''))
+
+
+def _is_good(result: dict) -> bool:
+    href = (result.get('href') or '').strip()
+    return href.startswith(("http://", "https://")) and not urlsplit(href).path.lower().endswith(".pdf")
+
+
+def search(query: str, max_results: int, providers: list = None, hedge_delay: float = None, deadline: float = None) -> list:
+    """複数の検索プロバイダーにヘッジ付きで問い合わせ、URLで重複を除いて順位付けした結果を返します。
+
+    最初のプロバイダーの応答が hedge_delay 秒以内に来ない場合やエラーの場合は、次のプロバイダーにも並行して問い合わせます。
+    重複のない結果が max_results 件集まった時点、またはすべての問い合わせが終わるか deadline 秒が経過した時点で戻ります。
+    結果は複数のプロバイダーで上位に現れたものほど上位になります（Reciprocal Rank Fusion）。
+    """
+    providers = list(default_providers() if providers is None else providers)
+    hedge_delay = WEB_SEARCH_HEDGE_DELAY if hedge_delay is None else hedge_delay
+    deadline_at = time.monotonic() + (WEB_SEARCH_DEADLINE if deadline is None else deadline)
+    executor = _get_executor()
+    merged = {}
+    running = {}
+    next_hedge_at = time.monotonic()
+
+    while (providers or running) and len(merged) < max_results:
+        now = time.monotonic()
+        if now >= deadline_at:
+            logging.warning(f"Web search deadline reached with {len(merged)}/{max_results} results.")
+            break
+        if providers and (not running or now >= next_hedge_at):
+            provider = providers.pop(0)
+            running[executor.submit(provider, query, max_results)] = getattr(provider, 'name', repr(provider))
+            next_hedge_at = now + hedge_delay
+            continue
+        timeout = min(deadline_at, next_hedge_at) - now if providers else deadline_at - now
+        done, _ = wait(list(running), timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                logging.warning(f"Web search provider {name} failed: {e}")
+                # 失敗した場合は待たずに次のプロバイダーへ問い合わせる
+                next_hedge_at = time.monotonic()
+                continue
+            for rank, result in enumerate(r for r in results if _is_good(r)):
+                key = normalize_url(result['href'])
+                entry = merged.setdefault(key, {**result, 'score': 0.0, 'sources': [], 'order': len(merged)})
+                if name not in entry['sources']:
+                    entry['sources'].append(name)
+                    entry['score'] += 1.0 / (rank + 1)
+
+    for future in running:
+        future.cancel()
+    ranked = sorted(merged.values(), key=lambda entry: (-entry['score'], entry['order']))
+    return [{k: v for k, v in entry.items() if k not in ('score', 'order')} for entry in ranked[:max_results]]